@@ -1,13 +1,118 @@
 from __future__ import annotations
 from argparse import ArgumentParser
-from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import Process, cpu_count
 from pathlib import Path
 
-from svgbit import load_10X, load_anndata_h5, load_table, run, plot
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+
+from svgbit import STDataset, load_10X, load_anndata_h5, load_table, run, plot
 from svgbit.filters import low_variance_filter, quantile_filter
 from svgbit.normalizers import logcpm_normalizer, cpm_normalizer
 
 
+def write_matrix_csv(df: pd.DataFrame, path: Path) -> None:
+    """
+    Write a (spot * gene) DataFrame to CSV with the pyarrow CSV writer.
+
+    Columns are handed to pyarrow without copies and then encoded in C++,
+    which is much faster than ``DataFrame.to_csv`` for wide matrices.
+
+    Parameters
+    ==========
+    df : pd.DataFrame
+        A dense DataFrame with spots as index.
+
+    path : pathlib.Path
+        File name to write.
+
+    """
+    table = pa.Table.from_arrays(
+        [pa.array(df.index.to_numpy(dtype=str))] +
+        [pa.array(column) for column in df.to_numpy().T],
+        names=["", *df.columns.astype(str)],
+    )
+    pa_csv.write_csv(table, path)
+
+
+def save_results(dataset: STDataset, savedir: Path, format: str) -> None:
+    """
+    Save hotspot_df, AI, Di and svg_cluster of a finished STDataset.
+
+    Parameters
+    ==========
+    dataset : STDataset
+        A STDataset with all steps finished.
+
+    savedir : pathlib.Path
+        Directory to save results.
+
+    format : str
+        One of ``csv``, ``parquet`` and ``npz``.
+
+    """
+    if format == "npz":
+        np.savez_compressed(
+            Path.joinpath(savedir, "results.npz"),
+            spots=dataset.spots.to_numpy(dtype=str),
+            genes=dataset.genes.to_numpy(dtype=str),
+            hotspot=dataset._hotspot_mat,
+            AI=dataset.AI.to_numpy(),
+            Di=dataset._Di_mat,
+            svg_genes=dataset.svg_cluster.index.to_numpy(dtype=str),
+            svg_cluster=dataset.svg_cluster.to_numpy(),
+        )
+        return
+
+    if format == "parquet":
+        tables = {
+            "hotspot_df": dataset.hotspot_df.astype("int8"),
+            "AI": dataset.AI.to_frame(name="AI"),
+            "Di": dataset.Di,
+            "svg_cluster": dataset.svg_cluster.to_frame(name="svg_cluster"),
+        }
+        tasks = [
+            partial(
+                df.to_parquet,
+                Path.joinpath(savedir, f"{name}.parquet"),
+                compression="zstd",
+            ) for name, df in tables.items()
+        ]
+    elif format == "csv":
+        tasks = [
+            partial(
+                write_matrix_csv,
+                dataset.hotspot_df,
+                Path.joinpath(savedir, "hotspot_df.csv"),
+            ),
+            partial(
+                dataset.AI.to_csv,
+                Path.joinpath(savedir, "AI.csv"),
+                float_format="%.6g",
+            ),
+            partial(
+                write_matrix_csv,
+                dataset.Di,
+                Path.joinpath(savedir, "Di.csv"),
+            ),
+            partial(
+                dataset.svg_cluster.to_csv,
+                Path.joinpath(savedir, "svg_cluster.csv"),
+            ),
+        ]
+    else:
+        raise ValueError(f"Not supported format: {format}")
+
+    # writers of independent files release the GIL while encoding
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        for future in [executor.submit(task) for task in tasks]:
+            future.result()
+
+
 def main() -> None:
     parser = ArgumentParser(
         prog="svgbit",
@@ -62,6 +167,13 @@ def main() -> None:
         default=cpu_count(),
         help='''number of threads to run svgbit (default: %(default)s)''',
     )
+    parser.add_argument(
+        "--format",
+        default="parquet",
+        choices=["csv", "parquet", "npz"],
+        help='''file format to save hotspot_df, AI, Di and svg_cluster
+                (default: %(default)s)''',
+    )
     args = parser.parse_args()
 
     read_path = Path(args.read_path)
@@ -78,7 +190,12 @@ def main() -> None:
                 sep = ","
             elif ".tsv" in read_path.suffixes:
                 sep = "\t"
-            kwargs = {"index_col": 0, "header": 0, "sep": sep}
+            kwargs = {
+                "index_col": 0,
+                "header": 0,
+                "sep": sep,
+                "engine": "pyarrow",
+            }
 
     d = load_func(read_path, **kwargs)
     d = low_variance_filter(d)
@@ -105,14 +222,25 @@ def main() -> None:
     savedir = Path(args.save_dir)
     if not savedir.exists():
         savedir.mkdir()
-    d.hotspot_df.to_csv(Path.joinpath(savedir, "hotspot_df.csv"))
-    d.AI.to_csv(Path.joinpath(savedir, "AI.csv"))
-    d.Di.to_csv(Path.joinpath(savedir, "Di.csv"))
-    d.svg_cluster.to_csv(Path.joinpath(savedir, "svg_cluster.csv"))
-
-    plot.svg_heatmap(d, Path.joinpath(savedir, "heatmap.jpg"), args.he_image)
-    plot.spot_type_map(d, Path.joinpath(savedir, "type_map.jpg"),
-                       args.he_image)
+
+    # render figures in other processes while results are being written
+    plot_processes = [
+        Process(
+            target=plot.svg_heatmap,
+            args=(d, Path.joinpath(savedir, "heatmap.jpg"), args.he_image),
+        ),
+        Process(
+            target=plot.spot_type_map,
+            args=(d, Path.joinpath(savedir, "type_map.jpg"), args.he_image),
+        ),
+    ]
+    for process in plot_processes:
+        process.start()
+    save_results(d, savedir, args.format)
+    for process in plot_processes:
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Plotting failed with exit code {process.exitcode}")
 
 
 if __name__ == "__main__":
@@ -1,8 +1,6 @@
 from __future__ import annotations
 
 import warnings
-from collections import Counter
-from copy import deepcopy
 from typing import Optional, Tuple, Union
 from pathlib import Path
 
@@ -10,10 +8,23 @@ import numpy as np
 import pandas as pd
 from libpysal.weights import KNN
 from libpysal.weights import W as libpysal_W
+from scipy import sparse
 
 from . import cluster, density, moran
+from .utils import df_to_spmatrix
+from .weights import KNNW
 
 DataFrames = Union[pd.DataFrame, np.ndarray, Path, str]
+Weights = Union[KNNW, libpysal_W]
+
+
+def _is_positional(pos) -> bool:
+    """Whether pos is an integer slice or an integer array."""
+    if isinstance(pos, slice):
+        return all(
+            i is None or isinstance(i, (int, np.integer))
+            for i in (pos.start, pos.stop, pos.step))
+    return isinstance(pos, np.ndarray) and pos.dtype.kind in "iu"
 
 
 class STDataset(object):
@@ -57,6 +68,26 @@ class STDataset(object):
     sort_spots : bool, default True
         Whether to sort spots with spots' name.
     """
+    __slots__ = (
+        "_count_df",
+        "_is_sparse",
+        "_spots",
+        "_genes",
+        "_coordinate_df",
+        "_coordinate_arr",
+        "_normalizer",
+        "_weight",
+        "_weight_type",
+        "_hotspot_mat",
+        "_lmi_mat",
+        "_lmp_mat",
+        "_AI",
+        "_Di_mat",
+        "_svg_cluster",
+        "_spot_type",
+        "_array_coordinate",
+    )
+
     def __init__(
         self,
         count_df: DataFrames,
@@ -72,22 +103,24 @@ class STDataset(object):
 
         # attributes initial
         self._count_df: Optional[pd.DataFrame] = None
+        self._is_sparse: bool = False
         self._coordinate_df: Optional[pd.DataFrame] = None
+        self._coordinate_arr: Optional[np.ndarray] = None
         self._normalizer: Optional[str] = None
-        self._weight: Optional[libpysal_W] = None
+        self._weight: Optional[Weights] = None
         self._weight_type: Tuple[Optional[str], Optional[str]] = (None, None)
-        self._hotspot_df: Optional[pd.DataFrame] = None
-        self._local_moran_i: Optional[pd.DataFrame] = None
-        self._local_moran_p: Optional[pd.DataFrame] = None
+        self._hotspot_mat: Optional[np.ndarray] = None
+        self._lmi_mat: Optional[np.ndarray] = None
+        self._lmp_mat: Optional[np.ndarray] = None
         self._AI: Optional[pd.Series] = None
-        self._Di: Optional[pd.DataFrame] = None
+        self._Di_mat: Optional[np.ndarray] = None
         self._svg_cluster: Optional[pd.Series] = None
         self._spot_type: Optional[pd.DataFrame] = None
         self._array_coordinate: Optional[pd.DataFrame] = None
 
         # dataframes check
         if isinstance(count_df, pd.DataFrame):
-            self._count_df = deepcopy(count_df)
+            self._count_df = count_df.copy(deep=True)
         elif isinstance(count_df, np.ndarray):
             self._count_df = pd.DataFrame(count_df)
         else:
@@ -96,7 +129,7 @@ class STDataset(object):
             self._count_df = self._count_df.T
 
         if isinstance(coordinate_df, pd.DataFrame):
-            self._coordinate_df = deepcopy(coordinate_df)
+            self._coordinate_df = coordinate_df.copy(deep=True)
         elif isinstance(coordinate_df, np.ndarray):
             self._coordinate_df = pd.DataFrame(coordinate_df)
         else:
@@ -108,48 +141,69 @@ class STDataset(object):
             self._coordinate_df = self._coordinate_df.T
 
         if sort_spots:
-            self._count_df.sort_index(inplace=True)
-            self._coordinate_df = self._coordinate_df.reindex(
-                index=self.count_df.index)
+            count_index = self._count_df.index
+            if not count_index.is_monotonic_increasing:
+                # one argsort gathers both frames if they share spot order
+                perm = np.argsort(count_index.to_numpy(), kind="stable")
+                self._count_df = self._count_df.iloc[perm]
+                if self._coordinate_df.index.equals(count_index):
+                    self._coordinate_df = self._coordinate_df.iloc[perm]
+            if not self._coordinate_df.index.equals(self._count_df.index):
+                self._coordinate_df = self._coordinate_df.reindex(
+                    index=self._count_df.index)
         self._coordinate_df.columns = ["X", "Y"]
 
         err = "Expression matrix and coordinate file have different number of spots."
         assert self._count_df.shape[0] == self._coordinate_df.shape[0], err
         err = "Spots' name mismatch!"
-        assert all(self._count_df.index == self._coordinate_df.index), err
+        assert self._count_df.index.equals(self._coordinate_df.index), err
+        self._coordinate_arr = np.ascontiguousarray(
+            self._coordinate_df.to_numpy(dtype=np.float64))
 
-        self._count_df.fillna(0, inplace=True)
+        # a read-only scan is cheaper than rewriting all blocks by fillna
+        if self._count_df.isna().any().any():
+            self._count_df.fillna(0, inplace=True)
 
         # Rename duplicated columns
         if check_duplicate_genes:
-            genes = []
-            flag = 0
-            c = Counter(self._count_df.columns)
-            gene_suffix = {}
-            for gene_name in self._count_df.columns:
-                if c[gene_name] > 1:
-                    flag = 1
-                    if gene_name in gene_suffix:
-                        gene_suffix[gene_name] += 1
-                        gene_name += f".{gene_suffix[gene_name]}"
-                    else:
-                        gene_suffix[gene_name] = 0
-                genes.append(gene_name)
-            if flag:
-                self._count_df.columns = genes
+            genes = self._count_df.columns
+            if genes.has_duplicates:
+                # first occurrence keeps its name, later ones get .1, .2, ...
+                names = genes.to_series(index=range(len(genes)))
+                n_seen = names.groupby(names, sort=False).cumcount().to_numpy()
+                self._count_df.columns = np.where(
+                    n_seen == 0,
+                    genes,
+                    genes.astype(str) + "." + n_seen.astype(str),
+                )
                 print("Duplicated column names found. Auto rename.")
                 warnings.warn("Duplicated column names found. Auto rename.")
 
+        # count_df labels are final here, conversions below keep them
+        self._spots = self._count_df.index
+        self._genes = self._count_df.columns
+
         if make_sparse:
             self.to_sparse()
+        elif self.n_genes and isinstance(self._count_df.dtypes.iloc[0],
+                                         pd.SparseDtype):
+            self._is_sparse = True
+        elif self.n_genes:
+            self._count_df = self._count_df.astype(np.float32)
 
     def __repr__(self) -> str:
         descr = f"STDataset with n_spots x n_genes = {self.n_spots} x {self.n_genes}"
         descr = f"{descr}\nApplied normalizers: {self._normalizer}"
         descr = f"{descr}\nAssigned attributes: "
         flag = 0
-        for attr in ["weight", "hotspot_df", "AI", "svg_cluster"]:
-            if getattr(self, attr) is not None:
+        # check backing fields, lazy properties would trigger computing
+        for attr, field in [
+            ("weight", "_weight"),
+            ("hotspot_df", "_hotspot_mat"),
+            ("AI", "_AI"),
+            ("svg_cluster", "_svg_cluster"),
+        ]:
+            if getattr(self, field) is not None:
                 descr += f"{attr}, "
                 flag = 1
         if flag:
@@ -163,46 +217,47 @@ class STDataset(object):
         """
         Return a sub STDataset instance with empty attributes.
         """
-        try:
-            count_sub = self.count_df.loc[pos]
-        except TypeError:
+        if _is_positional(pos) and not pd.api.types.is_integer_dtype(self.spots):
             count_sub = self.count_df.iloc[pos]
+        else:
+            try:
+                count_sub = self.count_df.loc[pos]
+            except TypeError:
+                count_sub = self.count_df.iloc[pos]
         coor_sub = self.coordinate_df.loc[count_sub.index, ]
         return STDataset(
             count_sub,
             coor_sub,
             check_duplicate_genes=False,
             sort_spots=False,
-            make_sparse=pd.api.types.is_sparse(self.count_df.iloc[:, 1]),
+            make_sparse=self._is_sparse,
         )
 
-    def __del__(self) -> None:
-        del self._count_df
-        del self._coordinate_df
-        del self._normalizer
-        del self._hotspot_df
-        del self._weight
-        del self._weight_type
-        del self._local_moran_i
-        del self._local_moran_p
-        del self._AI
-        del self._Di
-        del self._svg_cluster
-        del self._spot_type
-        del self._array_coordinate
-
     def to_dense(self) -> None:
         """Convert count_df with sparse values to dense."""
         self._count_df = self._count_df.sparse.to_dense()
+        self._is_sparse = False
 
     def to_sparse(self) -> None:
         """Convert count_df with dense values to sparse."""
-        is_int = [i == "int" for i in self.count_df.dtypes]
-        if all(is_int):
+        # distinct dtypes only, usually a single block; also true for
+        # integer SparseDtype so re-sparsifying keeps int64
+        dtypes = set(self._count_df.dtypes)
+        if all(pd.api.types.is_integer_dtype(dt) for dt in dtypes):
             dt = "int64"
         else:
-            dt = "float64"
-        self._count_df = self._count_df.astype(pd.SparseDtype(dt, 0))
+            dt = "float32"
+        if dtypes == {pd.SparseDtype(dt, 0)}:
+            # already sparse, e.g. given by loaders
+            self._is_sparse = True
+            return
+        # one CSC conversion of the whole matrix instead of per column astype
+        self._count_df = pd.DataFrame.sparse.from_spmatrix(
+            df_to_spmatrix(self._count_df, dtype=dt),
+            index=self._count_df.index,
+            columns=self._count_df.columns,
+        )
+        self._is_sparse = True
 
     def acquire_weight(self, k: int = 6, **kwargs) -> None:
         """
@@ -214,35 +269,45 @@ class STDataset(object):
             Number of nearest neighbors for KNN network.
 
         **kwargs
-            Additional keyword arguments passed to the libpysal.weights.KNN call.
+            Additional keyword arguments passed to the libpysal.weights.KNN
+            call. If not given, a cKDTree based ``KNNW`` is built instead of a
+            libpysal W.
 
         """
-        self._weight = KNN(self._coordinate_df, k=k, **kwargs)
+        if kwargs:
+            self._weight = KNN(self._coordinate_arr, k=k, **kwargs)
+        else:
+            self._weight = KNNW(self._coordinate_arr, k=k)
         self._weight_type = ("KNN", str(k))
 
-    def acquire_hotspot(self, **kwargs) -> None:
+    def acquire_hotspot(
+        self,
+        count_mat: Optional[sparse.csc_matrix] = None,
+        **kwargs,
+    ) -> None:
         """
         Acquire hotspot matrix.
 
         Parameters
         ==========
+        count_mat : scipy.sparse.csc_matrix, optional
+            Precomputed ``df_to_spmatrix(count_df)``. Converted from count_df
+            if not given.
+
         **kwargs
             Additional keyword arguments passed to local_moran call.
 
         """
         if self._weight is None:
             self.acquire_weight()
-        hotspot, i_value, p_value = moran.local_moran(
-            gene_expression_df=self.count_df,
+        if count_mat is None:
+            count_mat = df_to_spmatrix(self.count_df)
+        results = moran._local_moran(
+            count_mat,
             weights=self.weight,
             **kwargs,
         )
-        self._hotspot_df = hotspot.reindex(
-            index=self.spots,
-            columns=self.genes,
-        )
-        self._local_moran_i = i_value.astype(pd.SparseDtype("float", 0))
-        self._local_moran_p = p_value.astype(pd.SparseDtype("float", 0))
+        self._hotspot_mat, self._lmi_mat, self._lmp_mat = results
 
     def acquire_density(self, cores: int = density.cpu_count()) -> None:
         """
@@ -254,17 +319,19 @@ class STDataset(object):
             Number of threads to run svgbit. Use all available cpus by default.
 
         """
-        if self._hotspot_df is None:
+        if self._hotspot_mat is None:
             self.acquire_hotspot()
-        results = density.hotspot_AI(
-            hotspot_df=self._hotspot_df,
-            weight_df=-np.log(self._local_moran_p),
-            knn=self._weight,
+        # -log(p) in float32, negated in place to avoid a second temporary
+        weight_mat = np.log(self._lmp_mat, dtype=np.float32)
+        np.negative(weight_mat, out=weight_mat)
+        results = density._hotspot_AI(
+            self._hotspot_mat,
+            weight_mat,
+            density._knn_to_neighbors(self._weight),
             cores=cores,
         )
-        self._AI = results[0].reindex(index=self.genes)
-        self._Di = results[1].astype(pd.SparseDtype("float", 0)).reindex(
-            index=self.spots, columns=self.genes)
+        self._AI = pd.Series(results[0], index=self.genes, name="AI")
+        self._Di_mat = results[1]
 
     def find_clusters(
         self,
@@ -287,15 +354,19 @@ class STDataset(object):
             min value to identify multiple svg clusters to spot.
 
         """
+        if self._AI is None:
+            self.acquire_density()
         results = cluster.cluster(
-            self._hotspot_df,
+            self.hotspot_df,
             self._AI,
             n_svgs=n_svgs,
             n_svg_clusters=n_svg_clusters,
             threshold=threshold,
         )
+        # spot type table is built in the order of hotspot_df, no reindex
+        assert results[1].index.equals(self.spots)
         self._svg_cluster = results[0]
-        self._spot_type = results[1].reindex(index=self.spots)
+        self._spot_type = results[1]
 
     @property
     def count_df(self) -> pd.DataFrame:
@@ -310,30 +381,30 @@ class STDataset(object):
     @property
     def n_spots(self) -> int:
         """Number of total spots."""
-        return self._count_df.shape[0]
+        return len(self._spots)
 
     @property
     def spots(self) -> pd.Index:
         """An Index for spots' names."""
-        return self._count_df.index
+        return self._spots
 
     @property
     def n_genes(self) -> int:
         """Number of total genes."""
-        return self._count_df.shape[1]
+        return len(self._genes)
 
     @property
     def genes(self) -> pd.Index:
         """An Index for genes' names."""
-        return self._count_df.columns
+        return self._genes
 
     @property
-    def weight(self) -> libpysal_W:
+    def weight(self) -> Weights:
         """Weight used by svgbit. Use KNN if not specified."""
         return self._weight
 
     @weight.setter
-    def weight(self, value: libpysal_W):
+    def weight(self, value: Weights):
         self._weight = value
         self._weight_type = ("User specified weight", None)
 
@@ -347,27 +418,48 @@ class STDataset(object):
 
     @property
     def hotspot_df(self) -> pd.DataFrame:
-        """Hotspot matrix."""
-        return self._hotspot_df
+        """Hotspot matrix. Run ``acquire_hotspot`` if not acquired."""
+        if self._hotspot_mat is None:
+            self.acquire_hotspot()
+        return pd.DataFrame(
+            self._hotspot_mat.view(np.uint8),
+            index=self.spots,
+            columns=self.genes,
+        )
 
     @property
     def AI(self) -> pd.Series:
-        """A Series for AI value."""
+        """A Series for AI value. Run ``acquire_density`` if not acquired."""
+        if self._AI is None:
+            self.acquire_density()
         return self._AI
 
     @property
     def Di(self) -> pd.DataFrame:
-        """A DataFrame for local Di value."""
-        return self._Di
+        """
+        A DataFrame for local Di value. Run ``acquire_density`` if not
+        acquired.
+        """
+        if self._Di_mat is None:
+            self.acquire_density()
+        return pd.DataFrame(
+            self._Di_mat,
+            index=self.spots,
+            columns=self.genes,
+        )
 
     @property
     def svg_cluster(self) -> pd.Series:
-        """SVG cluster result."""
+        """SVG cluster result. Run ``find_clusters`` if not acquired."""
+        if self._svg_cluster is None:
+            self.find_clusters()
         return self._svg_cluster
 
     @property
     def spot_type(self) -> pd.DataFrame:
-        """A pd.DataFrame for spot type."""
+        """A pd.DataFrame for spot type. Run ``find_clusters`` if not acquired."""
+        if self._spot_type is None:
+            self.find_clusters()
         return self._spot_type
 
 
@@ -0,0 +1,300 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Callable, Tuple
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(inline="always")
+def _not_less(sim: float, observed: float) -> bool:
+    """
+    Whether a permuted I is not less than the observed one.
+
+    Count data give many permutations whose I equals the observed one,
+    only differing by rounding of the summation order, count them as ties.
+    """
+    return sim >= observed - 1e-9 * (abs(sim) + abs(observed))
+
+
+@njit(parallel=True, cache=True)
+def crand(
+    z: np.ndarray,
+    observed: np.ndarray,
+    scaling: np.ndarray,
+    self_weights: np.ndarray,
+    neighbor_offsets: np.ndarray,
+    neighbor_weights: np.ndarray,
+    permuted_ids: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Conditional randomization of local Moran's I for all genes.
+
+    Parameters
+    ==========
+    z : np.ndarray
+        Standardized expression matrix (n_spots * n_genes), C-contiguous.
+
+    observed : np.ndarray
+        Observed local Moran's I (n_spots * n_genes).
+
+    scaling : np.ndarray
+        Scaling factor of each gene.
+
+    self_weights : np.ndarray
+        Diagonal of the transformed spatial weight.
+
+    neighbor_offsets : np.ndarray
+        CSR ``indptr`` of the off-diagonal spatial weight.
+
+    neighbor_weights : np.ndarray
+        CSR ``data`` of the off-diagonal spatial weight.
+
+    permuted_ids : np.ndarray
+        Random ids (permutations * max_cardinality) drawn from ``n - 1``
+        spots, shared by all spots as in esda.
+
+    Returns
+    =======
+    p_sim : np.ndarray
+        Pseudo p values from conditional randomization.
+
+    ei_sim : np.ndarray
+        Average local Moran's I of permutations.
+
+    """
+    n, n_genes = z.shape
+    permutations = permuted_ids.shape[0]
+    p_sim = np.empty((n, n_genes), dtype=np.float64)
+    ei_sim = np.empty((n, n_genes), dtype=np.float64)
+
+    for i in prange(n):
+        start = neighbor_offsets[i]
+        cardinality = neighbor_offsets[i + 1] - start
+        larger = np.zeros(n_genes, dtype=np.int64)
+        total = np.zeros(n_genes, dtype=np.float64)
+        lag = np.empty(n_genes, dtype=np.float64)
+        for p in range(permutations):
+            for g in range(n_genes):
+                lag[g] = self_weights[i] * z[i, g]
+            for m in range(cardinality):
+                j = permuted_ids[p, m]
+                # skip spot i itself
+                if j >= i:
+                    j += 1
+                w = neighbor_weights[start + m]
+                for g in range(n_genes):
+                    lag[g] += w * z[j, g]
+            for g in range(n_genes):
+                sim = z[i, g] * lag[g] * scaling[g]
+                total[g] += sim
+                if _not_less(sim, observed[i, g]):
+                    larger[g] += 1
+        for g in range(n_genes):
+            count = larger[g]
+            if permutations - count < count:
+                count = permutations - count
+            p_sim[i, g] = (count + 1) / (permutations + 1)
+            ei_sim[i, g] = total[g] / permutations
+
+    return p_sim, ei_sim
+
+
+@njit(inline="always")
+def _decided(count: int, permutations: int) -> bool:
+    """
+    Whether the 95% Wilson score interval of a pseudo p value computed from
+    ``count`` folded exceedances in ``permutations`` excludes 0.05.
+    """
+    z2 = 1.96 * 1.96
+    q = count / permutations
+    denominator = 1 + z2 / permutations
+    center = (q + z2 / (2 * permutations)) / denominator
+    half = np.sqrt(q * (1 - q) / permutations + z2 /
+                   (4 * permutations * permutations)) * 1.96 / denominator
+    return center - half > 0.05 or center + half < 0.05
+
+
+@njit(parallel=True, cache=True)
+def crand_cells(
+    z: np.ndarray,
+    observed: np.ndarray,
+    scaling: np.ndarray,
+    self_weights: np.ndarray,
+    neighbor_offsets: np.ndarray,
+    neighbor_weights: np.ndarray,
+    permuted_ids: np.ndarray,
+    active: np.ndarray,
+    p_sim: np.ndarray,
+    ei_sim: np.ndarray,
+    check_every: int = 0,
+) -> None:
+    """
+    Conditional randomization of local Moran's I for selected cells only.
+
+    Same as ``crand``, except that only (spot, gene) cells marked in
+    ``active`` are permuted. Their results are written into ``p_sim`` and
+    ``ei_sim``, other cells are left untouched.
+
+    Parameters
+    ==========
+    z, observed, scaling, self_weights, neighbor_offsets, \
+    neighbor_weights, permuted_ids
+        See ``crand``.
+
+    active : np.ndarray
+        Boolean matrix (n_spots * n_genes) of cells to permute.
+
+    p_sim : np.ndarray
+        Pseudo p values (n_spots * n_genes) to fill in.
+
+    ei_sim : np.ndarray
+        Average local Moran's I of permutations (n_spots * n_genes) to fill
+        in.
+
+    check_every : int, default 0
+        If positive, every check_every permutations a cell stops once the
+        confidence interval of its pseudo p value excludes 0.05.
+
+    """
+    n, n_genes = z.shape
+    permutations = permuted_ids.shape[0]
+    block = check_every if check_every > 0 else permutations
+
+    for i in prange(n):
+        genes = np.flatnonzero(active[i])
+        n_active = len(genes)
+        start = neighbor_offsets[i]
+        cardinality = neighbor_offsets[i + 1] - start
+        larger = np.zeros(n_genes, dtype=np.int64)
+        total = np.zeros(n_genes, dtype=np.float64)
+        lag = np.empty(n_genes, dtype=np.float64)
+        p = 0
+        while p < permutations and n_active > 0:
+            stop = min(p + block, permutations)
+            if 4 * n_active > n_genes:
+                # contiguous rows of all genes are faster than gathering
+                # many active ones
+                for q in range(p, stop):
+                    for g in range(n_genes):
+                        lag[g] = self_weights[i] * z[i, g]
+                    for m in range(cardinality):
+                        j = permuted_ids[q, m]
+                        # skip spot i itself
+                        if j >= i:
+                            j += 1
+                        w = neighbor_weights[start + m]
+                        for g in range(n_genes):
+                            lag[g] += w * z[j, g]
+                    for g in range(n_genes):
+                        sim = z[i, g] * lag[g] * scaling[g]
+                        total[g] += sim
+                        if _not_less(sim, observed[i, g]):
+                            larger[g] += 1
+            else:
+                for q in range(p, stop):
+                    for a in range(n_active):
+                        lag[a] = self_weights[i] * z[i, genes[a]]
+                    for m in range(cardinality):
+                        j = permuted_ids[q, m]
+                        if j >= i:
+                            j += 1
+                        w = neighbor_weights[start + m]
+                        for a in range(n_active):
+                            lag[a] += w * z[j, genes[a]]
+                    for a in range(n_active):
+                        g = genes[a]
+                        sim = z[i, g] * lag[a] * scaling[g]
+                        total[g] += sim
+                        if _not_less(sim, observed[i, g]):
+                            larger[g] += 1
+            p = stop
+
+            # write finished cells and keep the undecided ones
+            remained = 0
+            for a in range(n_active):
+                g = genes[a]
+                count = larger[g]
+                if p - count < count:
+                    count = p - count
+                if p == permutations or _decided(count, p):
+                    p_sim[i, g] = (count + 1) / (p + 1)
+                    ei_sim[i, g] = total[g] / p
+                else:
+                    genes[remained] = g
+                    remained += 1
+            n_active = remained
+
+
+@lru_cache(maxsize=None)
+def fused_moran_hotspot(k: int) -> Callable:
+    """
+    Compile a fused local Moran's I and hotspot kernel for k neighbors.
+
+    ``k`` is a closure constant of the returned kernel, so numba builds
+    a specialized (unrollable) neighbor loop for every k, cached across
+    calls.
+
+    Parameters
+    ==========
+    k : int
+        Number of neighbors of every spot.
+
+    Returns
+    =======
+    kernel : Callable
+        ``kernel(z, neighbors, weight, scaling, permuted_ids)`` returning
+        ``(hotspot, p_sim, ei_sim)``. ``neighbors`` is the (n_spots * k)
+        neighbor ids array and ``weight`` the uniform transformed weight.
+
+    """
+    @njit(parallel=True, cache=True)
+    def kernel(z, neighbors, weight, scaling, permuted_ids):
+        n, n_genes = z.shape
+        permutations = permuted_ids.shape[0]
+        hotspot = np.zeros((n, n_genes), dtype=np.bool_)
+        p_sim = np.empty((n, n_genes), dtype=np.float32)
+        ei_sim = np.empty((n, n_genes), dtype=np.float32)
+
+        for i in prange(n):
+            lag = np.zeros(n_genes, dtype=np.float64)
+            for m in range(k):
+                j = neighbors[i, m]
+                for g in range(n_genes):
+                    lag[g] += z[j, g]
+            observed = np.empty(n_genes, dtype=np.float64)
+            for g in range(n_genes):
+                observed[g] = z[i, g] * lag[g] * weight * scaling[g]
+
+            larger = np.zeros(n_genes, dtype=np.int64)
+            total = np.zeros(n_genes, dtype=np.float64)
+            lag_sim = np.empty(n_genes, dtype=np.float64)
+            for p in range(permutations):
+                lag_sim[:] = 0.0
+                for m in range(k):
+                    j = permuted_ids[p, m]
+                    # skip spot i itself
+                    if j >= i:
+                        j += 1
+                    for g in range(n_genes):
+                        lag_sim[g] += z[j, g]
+                for g in range(n_genes):
+                    sim = z[i, g] * lag_sim[g] * weight * scaling[g]
+                    total[g] += sim
+                    if _not_less(sim, observed[g]):
+                        larger[g] += 1
+
+            for g in range(n_genes):
+                count = larger[g]
+                if permutations - count < count:
+                    count = permutations - count
+                p = (count + 1) / (permutations + 1)
+                p_sim[i, g] = p
+                ei_sim[i, g] = total[g] / permutations
+                # significant (p < 0.05) hotspots in High-High quadrant
+                hotspot[i, g] = (p < 0.05) and (z[i, g] > 0) and (lag[g] > 0)
+
+        return hotspot, p_sim, ei_sim
+
+    return kernel
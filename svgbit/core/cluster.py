@@ -1,9 +1,75 @@
 from __future__ import annotations
 
+import fastcluster
+import numpy as np
 import pandas as pd
+from numba import njit, prange
 from scipy.cluster import hierarchy as sch
 
 
+def _pack_bits(mat: np.ndarray) -> np.ndarray:
+    """
+    Pack each column of a 0/1 matrix into a row of uint64 words.
+
+    Parameters
+    ==========
+    mat : np.ndarray
+        A 0/1 matrix (n_spots * n_genes).
+
+    Returns
+    =======
+    bits : np.ndarray
+        Packed bits (n_genes * ceil(n_spots / 64)) in uint64.
+
+    """
+    packed = np.packbits(np.asarray(mat, dtype=bool).T, axis=1)
+    n_bytes = -(-packed.shape[1] // 8) * 8
+    bits = np.zeros((packed.shape[0], n_bytes), dtype=np.uint8)
+    bits[:, :packed.shape[1]] = packed
+    return bits.view(np.uint64)
+
+
+@njit(inline="always")
+def _popcount(x: np.uint64) -> np.uint64:
+    """SWAR popcount of a uint64 word."""
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = ((x & np.uint64(0x3333333333333333)) +
+         ((x >> np.uint64(2)) & np.uint64(0x3333333333333333)))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+@njit(parallel=True, cache=True)
+def _jaccard_pdist_bits(bits: np.ndarray) -> np.ndarray:
+    """
+    Condensed jaccard distances between rows of packed bits.
+
+    Parameters
+    ==========
+    bits : np.ndarray
+        Packed bits (n_genes * n_words) given by ``_pack_bits``.
+
+    Returns
+    =======
+    distmat : np.ndarray
+        Condensed distance vector, same as ``pdist(metric="jaccard")``.
+
+    """
+    n_genes, n_words = bits.shape
+    distmat = np.zeros(n_genes * (n_genes - 1) // 2, dtype=np.float64)
+    for a in prange(n_genes):
+        offset = n_genes * a - a * (a + 1) // 2 - a - 1
+        for b in range(a + 1, n_genes):
+            inter = 0
+            union = 0
+            for w in range(n_words):
+                inter += _popcount(bits[a, w] & bits[b, w])
+                union += _popcount(bits[a, w] | bits[b, w])
+            if union > 0:
+                distmat[offset + b] = (union - inter) / union
+    return distmat
+
+
 def cluster(
     hotspot_df: pd.DataFrame,
     AI_series: pd.Series,
@@ -37,34 +103,40 @@ def cluster(
         A Series of clustering result.
 
     """
+    hotspot_mat = hotspot_df.to_numpy() != 0
     selected_genes = AI_series.sort_values(ascending=False)[:n_svgs].index
-    hotspot_set = hotspot_df[selected_genes]
-    gene_distmat = sch.distance.pdist(hotspot_set.T, metric="jaccard")
-    Z_gene = sch.linkage(gene_distmat, method="ward")
+    hotspot_set = hotspot_mat[:, hotspot_df.columns.get_indexer(selected_genes)]
+    gene_distmat = _jaccard_pdist_bits(_pack_bits(hotspot_set))
+    Z_gene = fastcluster.linkage(
+        gene_distmat,
+        method="ward",
+        preserve_input=False,
+    )
     gene_result = pd.Series(
         sch.fcluster(Z_gene, t=n_svg_clusters, criterion="maxclust"),
         index=selected_genes,
     ).sort_values()
 
-    mean_df = pd.DataFrame(index=hotspot_df.index)
+    gene_idx = hotspot_df.columns.get_indexer(gene_result.index)
+    mean_mat = np.full((hotspot_mat.shape[0], n_svg_clusters), np.nan)
     for i in range(1, n_svg_clusters + 1):
-        genes = gene_result[gene_result == i].index
-        mean_df[i] = hotspot_df[genes].T.mean()
-
-    columns = ["spot_type"]
-    [columns.append(f"type_{i}") for i in range(1, 1 + n_svg_clusters)]
-    type_df = pd.DataFrame(columns=columns)
-    for spot in mean_df.index:
-        temp_df = pd.DataFrame(index=[spot], columns=columns)
-        sort_series = mean_df.loc[spot, :].sort_values(ascending=False)
-        n_multi = len(sort_series[sort_series > threshold])
-        spot_type = "singlet"
-        if sort_series.iloc[0] < 0.2:
-            spot_type = "uncertain"
-        if n_multi > 1:
-            spot_type = f"{n_multi}_multi_types"
-        temp_df.loc[spot, "spot_type"] = spot_type
-        temp_df.loc[spot, columns[1:]] = sort_series.index
-        type_df = pd.concat([type_df, temp_df])
+        cluster_idx = gene_idx[gene_result.to_numpy() == i]
+        if len(cluster_idx):
+            mean_mat[:, i - 1] = hotspot_mat[:, cluster_idx].mean(axis=1)
+
+    # descending order computed exactly as Series.sort_values does, so that
+    # tied clusters are ordered the same way; empty clusters go last
+    reversed_mean = np.nan_to_num(mean_mat[:, ::-1], nan=-np.inf)
+    order = np.argsort(reversed_mean, axis=1, kind="quicksort")
+    order = (n_svg_clusters - 1 - order)[:, ::-1]
+    sorted_mean = np.take_along_axis(mean_mat, order, axis=1)
+    n_multi = (sorted_mean > threshold).sum(axis=1)
+    spot_type = np.full(len(order), "singlet", dtype=object)
+    spot_type[sorted_mean[:, 0] < 0.2] = "uncertain"
+    spot_type[n_multi > 1] = [f"{i}_multi_types" for i in n_multi[n_multi > 1]]
+
+    columns = [f"type_{i}" for i in range(1, 1 + n_svg_clusters)]
+    type_df = pd.DataFrame(order + 1, index=hotspot_df.index, columns=columns)
+    type_df.insert(0, "spot_type", spot_type)
 
     return gene_result, type_df
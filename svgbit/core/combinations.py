@@ -1,12 +1,103 @@
-from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from typing import Optional, Union
 
 import numpy as np
 import pandas as pd
+from numba import njit, prange
+from sklearn.cluster import KMeans
 from sklearn.neighbors import NearestNeighbors
-from sklearn.mixture import BayesianGaussianMixture
 
 from .STDataset import STDataset
+from .cluster import _pack_bits, _popcount
+
+
+@njit(parallel=True, cache=True)
+def _cooccurrence_bits(bits: np.ndarray) -> np.ndarray:
+    """
+    Number of spots where two genes are both hotspots.
+
+    Parameters
+    ==========
+    bits : np.ndarray
+        Packed hotspot bits (n_genes * n_words) given by ``_pack_bits``.
+
+    Returns
+    =======
+    con_matrix : np.ndarray
+        Symmetric co-occurrence counts (n_genes * n_genes), the diagonal is
+        the number of hotspots of each gene.
+
+    """
+    n_genes, n_words = bits.shape
+    con_matrix = np.zeros((n_genes, n_genes), dtype=np.int64)
+    for a in prange(n_genes):
+        for b in range(a, n_genes):
+            count = 0
+            for w in range(n_words):
+                count += _popcount(bits[a, w] & bits[b, w])
+            con_matrix[a, b] = count
+            con_matrix[b, a] = count
+    return con_matrix
+
+
+def _score_degree(scores: np.ndarray) -> np.ndarray:
+    """
+    Bin 1-D scores into low, middle and high with 3-means clustering.
+
+    Parameters
+    ==========
+    scores : np.ndarray
+        Scores of gene pairs.
+
+    Returns
+    =======
+    degree : np.ndarray
+        ``"low"``, ``"middle"`` or ``"high"`` for each score.
+
+    """
+    # fixed seed, the single k-means++ init gives the same bins every run
+    kmeans = KMeans(n_clusters=3, n_init=1, random_state=0).fit(
+        scores.reshape(-1, 1))
+    rank = np.empty(3, dtype=int)
+    rank[kmeans.cluster_centers_.ravel().argsort()] = np.arange(3)
+    return np.array(["low", "middle", "high"], dtype=object)[rank[kmeans.labels_]]
+
+
+def _cluster_cooccurrence(
+    hotspot_df: pd.DataFrame,
+    spot_type: pd.DataFrame,
+    genes: pd.Index,
+) -> dict:
+    """
+    Co-occurrence counts of genes within each spot cluster.
+
+    Spots of a cluster never overlap with other clusters, so co-occurrence
+    over any union of clusters is the sum of the per-cluster matrices.
+
+    Parameters
+    ==========
+    hotspot_df : pd.DataFrame
+        A hotspot DataFrame generated by svgbit.
+
+    spot_type : pd.DataFrame
+        A pd.DataFrame for assigned type_df.
+
+    genes : pd.Index
+        Genes to count, all of which must be in ``hotspot_df``.
+
+    Returns
+    =======
+    cluster_con : dict
+        Cluster to co-occurrence counts (genes * genes) of its spots.
+
+    """
+    hotspot_mat = hotspot_df.reindex(columns=genes).to_numpy() != 0
+    spot_labels = spot_type["type_1"].reindex(hotspot_df.index)
+    return {
+        label: _cooccurrence_bits(_pack_bits(hotspot_mat[spot_idx]))
+        for label, spot_idx in spot_labels.groupby(spot_labels).indices.items()
+    }
 
 
 def _find_combinations(
@@ -17,6 +108,8 @@ def _find_combinations(
     center_spots: Union[int, list],
     selected_genes: Optional[list] = None,
     use_neighbor: bool = True,
+    cooccurrence: Optional[tuple] = None,
+    nbrs: Optional[NearestNeighbors] = None,
 ) -> pd.DataFrame:
     """
     Find gene pairs in certain SVG cluster.
@@ -43,6 +136,15 @@ def _find_combinations(
     use_neighbor : bool, default True
         Whether to find gene pairs with neighbor SVG clusters.
 
+    cooccurrence : tuple or None, default None
+        ``(genes, cluster_con)`` given by ``_cluster_cooccurrence``, shared
+        by calls for different SVG clusters. Used only when ``center_spots``
+        is a cluster and all selected genes are in ``genes``.
+
+    nbrs : sklearn.neighbors.NearestNeighbors or None, default None
+        7 nearest neighbors fitted on ``coordinate_df``, shared by calls for
+        different SVG clusters. Fitted here if None.
+
     Returns
     =======
     gene_pairs_df : pd.DataFrame
@@ -60,45 +162,42 @@ def _find_combinations(
 
     if use_neighbor and (not isinstance(center_spots, list)):
         # find neighbor clusters
-        certain_series = spot_type[spot_type["spot_type"] != "uncertain"]
-        certain_series = certain_series["type_1"]
-        nbrs = NearestNeighbors(n_neighbors=7).fit(coordinate_df)
-        neighbor_clusters_ = {}
-        for present_cluster in set(spot_type["type_1"]):
-            used_spots = []
-            neighbor_clusters_[present_cluster] = []
-            present_spots = certain_series[certain_series ==
-                                           present_cluster].index
-            distances, indices = nbrs.kneighbors(
-                coordinate_df.reindex(index=present_spots))
-            for record in indices:
-                for neighbor_spot in record[1:]:
-                    if neighbor_spot in used_spots:
-                        continue
-                    used_spots.append(neighbor_spot)
-                    neighbor_cluster = spot_type.iloc[neighbor_spot, 1]
-                    if neighbor_cluster == present_cluster:
-                        continue
-                    neighbor_clusters_[present_cluster].append(
-                        neighbor_cluster)
-
-        neighbor_clusters = {}
-        for i in neighbor_clusters_:
-            counter = Counter(neighbor_clusters_[i])
-            coverage_ = len(certain_series[certain_series == i]) * 0.03
-            neighbor_clusters[i] = [
-                j[0] for j in counter.most_common()[:3] if j[1] >= coverage_
-            ]
-            neighbor_clusters[i].append(i)
-
-        selected_spots = [
-            j for i in neighbor_clusters[center_spots]
-            for j in spot_type[spot_type["type_1"] == i].index
-        ]
-        selected_genes = [
-            j for i in neighbor_clusters[center_spots]
-            for j in svg_cluster[svg_cluster == i].index
-        ]
+        type_1 = spot_type["type_1"].to_numpy()
+        if center_spots not in set(type_1):
+            raise KeyError(center_spots)
+        if nbrs is None:
+            nbrs = NearestNeighbors(n_neighbors=7).fit(coordinate_df)
+        certain = spot_type["spot_type"].to_numpy() != "uncertain"
+        present_spots = spot_type.index[certain & (type_1 == center_spots)]
+        distances, indices = nbrs.kneighbors(
+            coordinate_df.reindex(index=present_spots))
+
+        # unique neighbor spots in first-seen order, as Counter would see them
+        neighbor_spots = indices[:, 1:].ravel()
+        _, first_seen = np.unique(neighbor_spots, return_index=True)
+        neighbor_spots = neighbor_spots[np.sort(first_seen)]
+        neighbor_types = type_1[neighbor_spots]
+        neighbor_types = neighbor_types[neighbor_types != center_spots]
+
+        # most common 3 neighbor clusters, ties kept in first-seen order
+        types, first_seen, counts = np.unique(
+            neighbor_types,
+            return_index=True,
+            return_counts=True,
+        )
+        order = np.lexsort((first_seen, -counts))[:3]
+        coverage_ = len(present_spots) * 0.03
+        neighbor_clusters = types[order][counts[order] >= coverage_].tolist()
+        neighbor_clusters.append(center_spots)
+
+        # positions of each cluster, grouped in one pass
+        type_to_spots = spot_type.groupby("type_1").indices
+        cluster_to_genes = svg_cluster.groupby(svg_cluster).indices
+        no_genes = np.array([], dtype=np.intp)
+        selected_spots = spot_type.index[np.concatenate(
+            [type_to_spots[i] for i in neighbor_clusters])]
+        selected_genes = svg_cluster.index[np.concatenate(
+            [cluster_to_genes.get(i, no_genes) for i in neighbor_clusters])]
     else:
         if isinstance(center_spots, list):
             selected_spots = center_spots
@@ -108,78 +207,77 @@ def _find_combinations(
                 center_spots = ", ".join(center_spots[:3])
                 center_spots = center_spots + "..."
         else:
-            selected_spots = spot_type[spot_type["type_1"] ==
-                                       center_spots].index
+            selected_spots = spot_type.index[
+                spot_type["type_1"].to_numpy() == center_spots]
             if selected_genes is None:
-                selected_genes = svg_cluster[svg_cluster == center_spots].index
+                selected_genes = svg_cluster.index[
+                    svg_cluster.to_numpy() == center_spots]
 
-    count_sub = hotspot_df.reindex(
-        index=selected_spots,
-        columns=selected_genes,
-    )
-    con_matrix = count_sub.T @ count_sub
-    n_hotspots = np.diag(con_matrix.to_numpy())
-    con_matrix = con_matrix - np.diag(n_hotspots)
-    men_matrix = (1 - count_sub.T) @ count_sub
-
-    con_ratio = con_matrix / len(selected_spots)
-    men_ratio = men_matrix / len(selected_spots)
-
-    gene_pairs_df = pd.DataFrame(columns=[
-        "SVG_cluster", "gene_1", "gene_2", "colocalization_score",
-        "exclusive_score"
-    ])
-    line = 0
-    for gene_1 in con_ratio.columns:
-        for gene_2 in con_ratio.index:
-            if gene_1 == gene_2:
-                continue
-            write_dict = {
-                "SVG_cluster": center_spots,
-                "gene_1": gene_1,
-                "gene_2": gene_2,
-                "colocalization_score": con_ratio[gene_1][gene_2],
-                "exclusive_score": men_ratio[gene_1][gene_2],
-            }
-            write_series = pd.Series(write_dict, name=line).to_frame().T
-            line += 1
-            gene_pairs_df = pd.concat([gene_pairs_df, write_series])
+    genes = pd.Index(selected_genes)
+    if cooccurrence is not None and isinstance(center_spots, int):
+        gene_idx = cooccurrence[0].get_indexer(genes)
+    else:
+        gene_idx = None
+    if gene_idx is not None and (gene_idx >= 0).all():
+        # selected spots are whole clusters, sum their precomputed counts
+        if use_neighbor:
+            spot_clusters = neighbor_clusters
+        else:
+            spot_clusters = [center_spots]
+        con_matrix = np.zeros((len(genes), len(genes)))
+        for i in spot_clusters:
+            if i in cooccurrence[1]:
+                con_matrix += cooccurrence[1][i][np.ix_(gene_idx, gene_idx)]
+        missing = np.zeros(len(genes), dtype=bool)
+    else:
+        # index the uint8 hotspots directly, reindex would upcast to float64
+        spot_idx = hotspot_df.index.get_indexer(selected_spots)
+        gene_idx = hotspot_df.columns.get_indexer(genes)
+        # genes or spots missing in hotspot_df give NaN (later 0) scores
+        missing = (gene_idx < 0) | (spot_idx < 0).any()
+        hotspot_mat = hotspot_df.to_numpy()[np.ix_(
+            spot_idx[spot_idx >= 0],
+            np.where(missing, 0, gene_idx),
+        )]
+        con_matrix = _cooccurrence_bits(
+            _pack_bits(np.nan_to_num(hotspot_mat) != 0)).astype(np.float64)
+    # scores of pair (gene_1, gene_2) are at [gene_1, gene_2]. con_matrix is
+    # symmetric, and exclusive counts are (1 - A).T @ A transposed, which is
+    # n_hotspots[gene_1] - con_matrix for a 0/1 matrix A
+    men_matrix = np.diag(con_matrix)[:, np.newaxis] - con_matrix
+    np.fill_diagonal(con_matrix, 0)
+    con_matrix[missing, :] = con_matrix[:, missing] = np.nan
+    men_matrix[missing, :] = men_matrix[:, missing] = np.nan
+    con_matrix /= len(selected_spots)
+    men_matrix /= len(selected_spots)
 
+    # pairs ordered by gene_1 then gene_2
+    genes = genes.to_numpy()
+    n_genes = len(genes)
+    pair_mask = ~np.eye(n_genes, dtype=bool).ravel()
+    gene_pairs_df = pd.DataFrame({
+        "SVG_cluster": center_spots,
+        "gene_1": np.repeat(genes, n_genes)[pair_mask],
+        "gene_2": np.tile(genes, n_genes)[pair_mask],
+        "colocalization_score": con_matrix.ravel()[pair_mask],
+        "exclusive_score": men_matrix.ravel()[pair_mask],
+    })
     gene_pairs_df.fillna(0, inplace=True)
 
-    gmm_con = BayesianGaussianMixture(
-        n_components=3,
-        max_iter=500,
-        n_init=5,
-    )
-    result_con = gmm_con.fit_predict(
-        gene_pairs_df["colocalization_score"].to_numpy().reshape(-1, 1))
-    rank_str = ["low", "middle", "high"]
-    mean_argsort = gmm_con.means_.argsort(axis=0).flatten()
-    rank_dict = {i: j for i, j in zip(mean_argsort, rank_str)}
-    result_con = [rank_dict[i] for i in result_con]
-    gene_pairs_df["colocalization_degree"] = result_con
-
-    gmm_men = BayesianGaussianMixture(
-        n_components=3,
-        max_iter=500,
-        n_init=5,
-    )
-    result_men = gmm_men.fit_predict(
-        gene_pairs_df["exclusive_score"].to_numpy().reshape(-1, 1))
-    mean_argsort = gmm_men.means_.argsort(axis=0).flatten()
-    rank_dict = {i: j for i, j in zip(mean_argsort, rank_str)}
-    result_men = [rank_dict[i] for i in result_men]
-    gene_pairs_df["exclusive_degree"] = result_men
+    gene_pairs_df["colocalization_degree"] = _score_degree(
+        gene_pairs_df["colocalization_score"].to_numpy())
+    gene_pairs_df["exclusive_degree"] = _score_degree(
+        gene_pairs_df["exclusive_score"].to_numpy())
 
     return gene_pairs_df
 
 
 def find_combinations(
     dataset: STDataset,
-    center_spots: Union[int, list],
+    center_spots: Union[int, list, None],
     selected_genes: Optional[list] = None,
     use_neighbor: bool = True,
+    cores: int = cpu_count(),
 ) -> pd.DataFrame:
     """
     Find gene pairs in certain SVG cluster.
@@ -189,10 +287,11 @@ def find_combinations(
     dataset : STDataset
         A STDataset with all steps finished.
 
-    center_spots : int or list
+    center_spots : int, list or None
         If a ``int`` is given, find gene pairs for this SVG cluster. If a
         ``list`` of spots is given, find gene pairs within those spots.
         ``selected_genes`` should be given if ``center_cluster`` is a ``list``.
+        If None, find gene pairs for every SVG cluster and concatenate them.
 
     selected_genes : list or None, default None
         If a ``list`` of genes is given, find gene pairs within given genes.
@@ -200,17 +299,63 @@ def find_combinations(
     use_neighbor : bool, default True
         Whether to find gene pairs with neighbor SVG clusters.
 
+    cores : int
+        Number of threads to find gene pairs of SVG clusters concurrently if
+        ``center_spots`` is None. Use all available cpus by default.
+
     Returns
     =======
     gene_pairs_df : pd.DataFrame
         A pd.DataFrame for gene pairs in center_cluster with weights.
     """
-    return _find_combinations(
-        dataset.hotspot_df,
-        dataset.coordinate_df,
-        dataset.spot_type,
-        dataset.svg_cluster,
-        center_spots,
-        selected_genes,
-        use_neighbor,
+    if center_spots is not None:
+        return _find_combinations(
+            dataset.hotspot_df,
+            dataset.coordinate_df,
+            dataset.spot_type,
+            dataset.svg_cluster,
+            center_spots,
+            selected_genes,
+            use_neighbor,
+        )
+
+    # clusters overlap in spots and genes, count co-occurrence only once
+    hotspot_df = dataset.hotspot_df
+    genes = dataset.svg_cluster.index
+    if selected_genes is not None:
+        # genes missing in hotspot_df are left to the per-cluster NaN path,
+        # which scores them 0
+        genes = genes.union(
+            pd.Index(selected_genes).intersection(hotspot_df.columns),
+            sort=False,
+        )
+    cooccurrence = (
+        genes,
+        _cluster_cooccurrence(hotspot_df, dataset.spot_type, genes),
     )
+    # fit once for all clusters; sklearn also decides which of equidistant
+    # neighbors on square grids are taken, keep it for the same results
+    nbrs = NearestNeighbors(n_neighbors=7).fit(dataset.coordinate_df)
+    # threads share the DataFrames and co-occurrence counts without
+    # pickling, each cluster only slices arrays and fits the two small
+    # KMeans of _score_degree, mostly in numpy releasing the GIL
+    clusters = np.unique(dataset.svg_cluster)
+    with ThreadPoolExecutor(max_workers=max(1, cores)) as executor:
+        futures = [
+            executor.submit(
+                _find_combinations,
+                hotspot_df,
+                dataset.coordinate_df,
+                dataset.spot_type,
+                dataset.svg_cluster,
+                cluster,
+                selected_genes,
+                use_neighbor,
+                cooccurrence,
+                nbrs,
+            ) for cluster in clusters
+        ]
+        return pd.concat(
+            [future.result() for future in futures],
+            ignore_index=True,
+        )
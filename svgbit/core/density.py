@@ -1,99 +1,160 @@
 from __future__ import annotations
 
-from functools import partial
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 from typing import Tuple, Union
 
+import numba
 import numpy as np
 import pandas as pd
 from libpysal.weights import W as libpysal_W
+from numba import njit, prange
 
-from .utils import pysal_to_pandas
+from .utils import pysal_to_neighbors, zeros_matrix
+from .weights import KNNW
 
 
-def _hotspot_AI(
-    hotspot_series: pd.Series,
-    weight_df: pd.DataFrame,
-    knn: Union[pd.DataFrame, libpysal_W],
-) -> Tuple[pd.Series, pd.Series]:
+def _knn_to_neighbors(
+        knn: Union[pd.DataFrame, libpysal_W, KNNW]) -> np.ndarray:
     """
-    Calculate Spatial Transcriptomics AI value for a single gene.
+    Convert a KNN network into positional neighbor ids padded with -1.
 
     Parameters
     ==========
-    gene : str
-        Calculate which gene.
+    knn : pd.DataFrame, libpysal.weights.W or KNNW
+        KNN network used for neighbor idenfication.
 
-    hotspot_df : pd.DataFrame
-        A hotspot DataFrame generated by svgbit.
+    Returns
+    =======
+    neighbors_arr : np.ndarray
+        Neighbor ids (n_spots * max cardinality) of each spot.
 
-    weight_df : pd.DataFrame
-        Weight used by AI. In default, svgbit uses local Moran's I p value as weight.
+    """
+    if isinstance(knn, KNNW):
+        return knn.neighbors
+    if isinstance(knn, libpysal_W):
+        return pysal_to_neighbors(knn)
+    adjacency = knn.to_numpy().T == 1
+    cardinalities = adjacency.sum(axis=1)
+    neighbors_arr = np.full(
+        (adjacency.shape[0], cardinalities.max()),
+        -1,
+        dtype=np.int32,
+    )
+    rows, cols = np.nonzero(adjacency)
+    slots = np.arange(len(rows)) - np.repeat(
+        np.cumsum(cardinalities) - cardinalities,
+        cardinalities,
+    )
+    neighbors_arr[rows, slots] = cols
+    return neighbors_arr
 
-    knn : pd.DataFrame or libpysal.weights.W
-        KNN network used for neighbor idenfication.
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _ai_di_kernel(
+    hotspot_mat: np.ndarray,
+    weight_mat: np.ndarray,
+    neighbors: np.ndarray,
+    di_mat: np.ndarray,
+) -> np.ndarray:
+    """
+    Calculate AI and local Di values for all genes.
+
+    Parameters
+    ==========
+    hotspot_mat : np.ndarray
+        Boolean hotspot matrix (n_spots * n_genes).
+
+    weight_mat : np.ndarray
+        Weight matrix (n_spots * n_genes) used by AI.
+
+    neighbors : np.ndarray
+        Positional neighbor ids (n_spots * k) of each spot, padded with -1.
+
+    di_mat : np.ndarray
+        Zero-filled output matrix (n_spots * n_genes) for local Di values.
 
     Returns
     =======
-    ai_series : pd.Series
-        A Series for AI value.
+    ai_array : np.ndarray
+        AI value of each gene.
+
+    """
+    n, n_genes = hotspot_mat.shape
+    k = neighbors.shape[1]
+    ai_array = np.zeros(n_genes, dtype=np.float64)
+    for g in prange(n_genes):
+        n_hotspots = 0
+        di_sum = 0.0
+        for i in range(n):
+            if not hotspot_mat[i, g]:
+                continue
+            n_hotspots += 1
+            s = 0.0
+            t = 0.0
+            for j in range(k):
+                nb = neighbors[i, j]
+                if nb < 0:
+                    continue
+                w = weight_mat[nb, g]
+                t += w
+                if hotspot_mat[nb, g]:
+                    s += w
+            if t > 0:
+                di_mat[i, g] = s / t
+                di_sum += s / t
+        if n_hotspots > 0:
+            ai_array[g] = di_sum / n_hotspots
+    return ai_array
 
-    di_series : pd.Series
-        A Series for local Di value.
 
+def _hotspot_AI(
+    hotspot_mat: np.ndarray,
+    weight_mat: np.ndarray,
+    neighbors_arr: np.ndarray,
+    cores: int = cpu_count(),
+) -> Tuple[np.ndarray, np.ndarray]:
     """
-    try:
-        hotspot_series = hotspot_series.sparse.to_dense()
-    except AttributeError:
-        pass
-    try:
-        weight_df = weight_df.sparse.to_dense()
-    except AttributeError:
-        pass
+    Calculate Spatial Transcriptomics AI value for all genes on ndarrays.
 
-    if isinstance(knn, libpysal_W):
-        knn = pysal_to_pandas(knn)
-        knn.index = hotspot_series.index
-        knn.columns = hotspot_series.index
-
-    gene_hotspot_series = hotspot_series[hotspot_series != 0]
-    n_hotspots = len(gene_hotspot_series)
-    gene = hotspot_series.name
-    spots = hotspot_series.index
-    if n_hotspots == 0:
-        ai_series = pd.Series([0], index=[gene], name="AI")
-        di_series = pd.Series(
-            [0] * len(hotspot_series),
-            index=spots,
-            name=gene,
-        )
-        return ai_series, di_series
-    hotspots = gene_hotspot_series.index.tolist()
-    hs = {}
-    for i in hotspots:
-        hi_wnn_df = pd.DataFrame(knn[i], columns=[i])
-        hi_wnn_df = pd.DataFrame(hi_wnn_df[hi_wnn_df[i] == 1])
-        knn_coors = hi_wnn_df.index.tolist()
-        inter_spots = list(set(hotspots).intersection(set(knn_coors)))
-        hs[i] = ((weight_df[gene][inter_spots] /
-                  weight_df[gene][knn_coors].sum()).sum())
-
-    di_array = np.array(list(hs.values()))
-    di_sum = di_array.sum()
-    di_mean = di_sum / n_hotspots
-    ai_series = pd.Series([di_mean], index=[gene], name="AI")
-    di_series = pd.Series(
-        hs,
-        name=gene,
-    ).reindex(index=spots).fillna(0)
-
-    return ai_series, di_series
+    Parameters
+    ==========
+    hotspot_mat : np.ndarray
+        Boolean hotspot matrix (n_spots * n_genes).
+
+    weight_mat : np.ndarray
+        Weight matrix (n_spots * n_genes) used by AI.
+
+    neighbors_arr : np.ndarray
+        Positional neighbor ids (n_spots * k) of each spot, padded with -1.
+
+    cores : int
+        Number of threads to run svgbit. Use all available cpus by default.
+
+    Returns
+    =======
+    ai_array : np.ndarray
+        AI value of each gene.
+
+    di_mat : np.ndarray
+        Local Di value matrix (n_spots * n_genes) in Fortran order, backed
+        by a temporary ``np.memmap`` if it is too large to keep in memory.
+
+    """
+    numba.set_num_threads(max(1, min(cores, numba.config.NUMBA_NUM_THREADS)))
+    di_mat = zeros_matrix(hotspot_mat.shape, np.float32)
+    ai_array = _ai_di_kernel(
+        np.asfortranarray(hotspot_mat, dtype=bool),
+        np.asfortranarray(weight_mat, dtype=np.float32),
+        neighbors_arr,
+        np.asarray(di_mat),
+    )
+    return ai_array, di_mat
 
 
 def hotspot_AI(
         hotspot_df: pd.DataFrame,
         weight_df: pd.DataFrame,
-        knn: Union[pd.DataFrame, libpysal_W],
+        knn: Union[pd.DataFrame, libpysal_W, KNNW],
         cores: int = cpu_count(),
 ) -> Tuple[pd.Series, pd.DataFrame]:
     """
@@ -107,7 +168,7 @@ def hotspot_AI(
     weight_df : pd.DataFrame
         Weight used by AI. In default, svgbit uses local Moran's I p value as weight.
 
-    knn : pd.DataFrame or libpysal.weights.W
+    knn : pd.DataFrame, libpysal.weights.W or KNNW
         KNN network used for neighbor idenfication.
 
     cores : int
@@ -122,24 +183,33 @@ def hotspot_AI(
         A DataFrame for local Di value.
 
     """
-    if isinstance(knn, libpysal_W):
-        knn = pysal_to_pandas(knn)
-        knn.index = hotspot_df.index
-        knn.columns = hotspot_df.index
-    partial_func = partial(
-        _hotspot_AI,
-        weight_df=weight_df,
-        knn=knn,
+    try:
+        hotspot_df = hotspot_df.sparse.to_dense()
+    except AttributeError:
+        pass
+    try:
+        weight_df = weight_df.sparse.to_dense()
+    except AttributeError:
+        pass
+    if not (weight_df.index.equals(hotspot_df.index)
+            and weight_df.columns.equals(hotspot_df.columns)):
+        weight_df = weight_df.reindex(
+            index=hotspot_df.index,
+            columns=hotspot_df.columns,
+        )
+
+    ai_array, di_mat = _hotspot_AI(
+        hotspot_df.to_numpy() != 0,
+        weight_df.to_numpy(dtype=np.float32),
+        _knn_to_neighbors(knn),
+        cores=cores,
     )
-    pool = Pool(processes=cores)
-    result_lists = pool.map(
-        partial_func,
-        [hotspot_df[i] for i in hotspot_df.columns],
+    ai_series = pd.Series(ai_array, index=hotspot_df.columns, name="AI")
+    di_df = pd.DataFrame(
+        di_mat,
+        index=hotspot_df.index,
+        columns=hotspot_df.columns,
     )
-    pool.close()
-    pool.join()
-    ai_series = pd.concat([i[0] for i in result_lists], axis=0)
-    di_df = pd.concat([i[1] for i in result_lists], axis=1)
 
     return ai_series, di_df
 
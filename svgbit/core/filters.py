@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-import pandas as pd
+import numpy as np
 
 from .STDataset import STDataset
+from .utils import df_to_spmatrix, sparse_var
 
 
 def low_variance_filter(dataset: STDataset, var: float = 0) -> STDataset:
@@ -22,15 +23,9 @@ def low_variance_filter(dataset: STDataset, var: float = 0) -> STDataset:
     dataset : STDataset
         A new STDataset instance with filtered genes.
     """
-    var_series = pd.Series()
-    for gene in dataset.count_df.columns:
-        try:
-            var_series[gene] = dataset.count_df[gene].sparse.to_dense().var()
-        except AttributeError:
-            var_series[gene] = dataset.count_df[gene].var()
-    var_series = var_series[var_series > var]
+    gene_var = sparse_var(df_to_spmatrix(dataset.count_df))
     return_dset = STDataset(
-        dataset.count_df.reindex(columns=var_series.index),
+        dataset.count_df.iloc[:, gene_var > var],
         dataset.coordinate_df,
         check_duplicate_genes=False,
         sort_spots=False,
@@ -60,13 +55,11 @@ def high_expression_filter(
     dataset : STDataset
         A new STDataset instance with filtered genes.
     """
-    temp_df = dataset.count_df.where(dataset.count_df < 1, 1)
-    temp_series = temp_df.sum() / temp_df.shape[0]
-    drop_genes = []
-    for i in temp_series.index:
-        if temp_series[i] > max_ratio:
-            drop_genes.append(i)
-    count_df = dataset.count_df.drop(columns=drop_genes)
+    # expression ratio is the mean of counts clipped to 1
+    count_mat = df_to_spmatrix(dataset.count_df)
+    np.minimum(count_mat.data, 1, out=count_mat.data)
+    ratio = np.asarray(count_mat.sum(axis=0)).ravel() / count_mat.shape[0]
+    count_df = dataset.count_df.iloc[:, ~(ratio > max_ratio)]
     return_dset = STDataset(
         count_df,
         dataset.coordinate_df,
@@ -94,10 +87,12 @@ def quantile_filter(dataset: STDataset, quantile: float = 0.99) -> STDataset:
     dataset : STDataset
         A new STDataset instance with filtered genes.
     """
-    mean_series = dataset.count_df.mean()
-    q = mean_series.quantile(quantile)
-    remain_genes = mean_series[mean_series < q].index
-    count_df = dataset.count_df.reindex(columns=remain_genes)
+    # means of the float64 CSC matrix, pandas truncates means of sparse
+    # integer columns to integers
+    gene_mean = np.asarray(
+        df_to_spmatrix(dataset.count_df).mean(axis=0)).ravel()
+    q = np.quantile(gene_mean, quantile)
+    count_df = dataset.count_df.iloc[:, gene_mean < q]
     return_dset = STDataset(
         count_df,
         dataset.coordinate_df,
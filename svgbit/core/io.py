@@ -8,9 +8,89 @@ import h5py
 import numpy as np
 import pandas as pd
 import scipy.io
+from scipy import sparse
 from .STDataset import STDataset
 
 
+def _long_to_dataset(
+    spot_codes: np.ndarray,
+    spots: pd.Index,
+    gene_codes: np.ndarray,
+    genes: pd.Index,
+    x: np.ndarray,
+    y: np.ndarray,
+    counts: np.ndarray,
+) -> STDataset:
+    """
+    Generate STDataset from a long table, one line per gene in a spot.
+
+    Lines are given as factorized spot and gene codes. Spots keep the order
+    of ``spots`` and genes the order they are first seen spot by spot.
+    Coordinates of a spot are taken from its first line and counts of
+    repeated lines are summed.
+    """
+    by_spot = np.argsort(spot_codes, kind="stable")
+    gene_order = np.empty_like(gene_codes)
+    gene_order[by_spot], first_genes = pd.factorize(gene_codes[by_spot])
+    count_mat = sparse.coo_matrix(
+        (np.asarray(counts, dtype=np.float32), (spot_codes, gene_order)),
+        shape=(len(spots), len(first_genes)),
+    ).tocsc()
+    count_df = pd.DataFrame.sparse.from_spmatrix(
+        count_mat,
+        index=spots,
+        columns=genes[first_genes],
+    )
+    first_line = np.unique(spot_codes, return_index=True)[1]
+    coor_df = pd.DataFrame(
+        {
+            "X": np.asarray(x)[first_line],
+            "Y": np.asarray(y)[first_line],
+        },
+        index=spots,
+    )
+
+    return STDataset(count_df, coor_df)
+
+
+def _read_10X_h5(h5_path: Path) -> tuple:
+    """
+    Read a 10X feature-barcode matrix from the Space Ranger HDF5 file.
+
+    Parameters
+    ==========
+    h5_path : pathlib.Path
+        Path to ``filtered_feature_bc_matrix.h5`` or the like.
+
+    Returns
+    =======
+    count_mat : scipy.sparse.csc_matrix
+        Count matrix (n_spots * n_genes).
+
+    spot_name : list
+        Barcodes of spots.
+
+    gene_name : list
+        Names of genes.
+
+    """
+    with h5py.File(h5_path, "r") as f:
+        matrix = f["matrix"]
+        n_genes, n_spots = matrix["shape"][:]
+        # columns of the (gene * spot) CSC matrix are rows of a CSR matrix
+        count_mat = sparse.csr_matrix(
+            (
+                matrix["data"][:].astype(np.int64),
+                matrix["indices"][:],
+                matrix["indptr"][:],
+            ),
+            shape=(n_spots, n_genes),
+        ).tocsc()
+        spot_name = [i.decode() for i in matrix["barcodes"][:]]
+        gene_name = [i.decode() for i in matrix["features"]["name"][:]]
+    return count_mat, spot_name, gene_name
+
+
 def load_10X(
     read_path,
     file_name="filtered_feature_bc_matrix",
@@ -24,7 +104,8 @@ def load_10X(
     read_path : str or pathlib.Path
         A location points to 10X outs dir. Assume directories
         filename and ``spatial`` are in this
-        path.
+        path. If ``{file_name}.h5`` is there, counts are read from it
+        instead of the Matrix Market directory.
 
     make_sparse : bool, default True
         Whether to use sparse DataFrame in order to save memory.
@@ -42,29 +123,47 @@ def load_10X(
     position_path = Path.joinpath(read_path, "spatial",
                                   "tissue_positions_list.csv")
 
-    gene_name = []
-    with gzip.open(features_path, "rt") as f:
-        for line in f:
-            line = line.strip()
-            gene_name.append(line.split("\t")[1])
-
-    spot_name = []
-    with gzip.open(barcodes_path, "rt") as f:
-        for line in f:
-            line = line.strip()
-            spot_name.append(line)
-
-    count_df = pd.DataFrame.sparse.from_spmatrix(scipy.io.mmread(mtx_path), ).T
-    count_df.index = spot_name
-    count_df.columns = gene_name
+    h5_path = Path.joinpath(read_path, f"{file_name}.h5")
+    if h5_path.exists():
+        count_mat, spot_name, gene_name = _read_10X_h5(h5_path)
+    else:
+        gene_name = []
+        with gzip.open(features_path, "rt") as f:
+            for line in f:
+                line = line.strip()
+                gene_name.append(line.split("\t")[1])
+
+        spot_name = []
+        with gzip.open(barcodes_path, "rt") as f:
+            for line in f:
+                line = line.strip()
+                spot_name.append(line)
+
+        # transpose in scipy, transposing a sparse DataFrame is slow
+        count_mat = scipy.io.mmread(mtx_path).T.tocsc()
+    count_df = pd.DataFrame.sparse.from_spmatrix(
+        count_mat,
+        index=spot_name,
+        columns=gene_name,
+    )
 
     try:
-        coor_df = pd.read_csv(position_path, index_col=0, header=None)
+        coor_df = pd.read_csv(
+            position_path,
+            index_col=0,
+            header=None,
+            engine="pyarrow",
+        )
         spaceranger_version = "v1"
     except FileNotFoundError:
         position_path = Path.joinpath(read_path, "spatial",
                                       "tissue_positions.csv")
-        coor_df = pd.read_csv(position_path, index_col=0, header=0)
+        coor_df = pd.read_csv(
+            position_path,
+            index_col=0,
+            header=0,
+            engine="pyarrow",
+        )
         spaceranger_version = "v2"
     if spaceranger_version == "v1":
         array_coor = coor_df[[3, 2]]
@@ -107,7 +206,7 @@ def load_anndata_h5(read_path, **kwargs) -> STDataset:
     """
     adata = anndata.read_h5ad(read_path, **kwargs)
     count_df = pd.DataFrame.sparse.from_spmatrix(
-        adata.X,
+        sparse.csc_matrix(adata.X),
         index=adata.obs.index,
         columns=adata.var.index,
     )
@@ -115,9 +214,6 @@ def load_anndata_h5(read_path, **kwargs) -> STDataset:
     coor_df.index = count_df.index
     coor_df.columns = ["X", "Y"]
 
-    if isinstance(count_df.iloc[0, 0], np.float32):
-        count_df = count_df.astype(np.float64)
-
     dataset = STDataset(count_df, coor_df)
     return dataset
 
@@ -145,7 +241,8 @@ def load_table(read_path, **kwargs) -> STDataset:
         File name to read from.
 
     **kwargs
-        Additional keyword arguments passed to pd.read_csv
+        Additional keyword arguments passed to pd.read_csv. Pass
+        ``engine="pyarrow"`` to parse large tables with multiple threads.
 
     Returns
     =======
@@ -153,26 +250,24 @@ def load_table(read_path, **kwargs) -> STDataset:
         A STDataset instance generated from read_dir.
     """
     read_df = pd.read_csv(read_path, **kwargs)
-    count_dict = {}
-    coor_dict = {}
-    for it in read_df.iterrows():
-        try:
-            spot_name = it[1].iloc[3]
-        except IndexError:
-            spot_name = f"{it[1].iloc[0]}x{it[1].iloc[1]}"
-        if spot_name not in coor_dict.keys():
-            coor_dict[spot_name] = {"X": it[1].iloc[0], "Y": it[1].iloc[1]}
-        if spot_name not in count_dict.keys():
-            count_dict[spot_name] = {}
-        if it[0] not in count_dict[spot_name].keys():
-            count_dict[spot_name][it[0]] = it[1][2]
-        else:
-            count_dict[spot_name][it[0]] += it[1][2]
-    count_df = pd.DataFrame.from_dict(count_dict).fillna(0).T
-    coor_df = pd.DataFrame.from_dict(coor_dict).T
-    coor_df = coor_df.reindex(index=count_df.index)
-
-    return STDataset(count_df, coor_df)
+    if read_df.shape[1] > 3:
+        spot_names = read_df.iloc[:, 3]
+    else:
+        spot_names = (read_df.iloc[:, 0].astype(str) + "x" +
+                      read_df.iloc[:, 1].astype(str))
+
+    spot_codes, spots = pd.factorize(spot_names)
+    gene_codes, genes = pd.factorize(read_df.index)
+
+    return _long_to_dataset(
+        spot_codes,
+        spots,
+        gene_codes,
+        genes,
+        read_df.iloc[:, 0],
+        read_df.iloc[:, 1],
+        read_df.iloc[:, 2],
+    )
 
 
 def load_gef(read_path, slot="bin20") -> STDataset:
@@ -189,28 +284,29 @@ def load_gef(read_path, slot="bin20") -> STDataset:
     dataset : STDataset
         A STDataset instance generated from read_dir.
     """
-    count_dict = {}
-    coor_dict = {}
-    f = h5py.File(read_path)
-    for record in f["geneExp"][slot]["gene"]:
-        gene_symbol = record[0].decode("utf8")
-        begin_line = record[1]
-        end_line = record[1] + record[2] - 1
-        exp = f["geneExp"][slot]["expression"][begin_line:end_line]
-        for line in exp:
-            line = list(map(int, line))
-            spot_name = f"{line[0]}x{line[1]}"
-            if spot_name not in coor_dict.keys():
-                coor_dict[spot_name] = {"X": line[0], "Y": line[1]}
-            if spot_name not in count_dict.keys():
-                count_dict[spot_name] = {}
-            if gene_symbol not in count_dict[spot_name].keys():
-                count_dict[spot_name][gene_symbol] = line[2]
-            else:
-                count_dict[spot_name][gene_symbol] += line[2]
-    count_df = pd.DataFrame.from_dict(count_dict).fillna(0).T
-    coor_df = pd.DataFrame.from_dict(coor_dict).T
-    coor_df = coor_df.reindex(index=count_df.index)
-    f.close()
-
-    return STDataset(count_df, coor_df)
+    with h5py.File(read_path) as f:
+        gene_table = f["geneExp"][slot]["gene"][:]
+        exp_table = f["geneExp"][slot]["expression"][:]
+    gene_fields = gene_table.dtype.names
+    exp_fields = exp_table.dtype.names
+
+    # lines of gene i are exp_table[offset_i:offset_i + count_i]
+    offsets = gene_table[gene_fields[1]].astype(np.int64)
+    n_lines = gene_table[gene_fields[2]].astype(np.int64)
+    gene_codes = np.repeat(np.arange(len(gene_table)), n_lines)
+    lines = np.arange(len(gene_codes)) + np.repeat(
+        offsets - (np.cumsum(n_lines) - n_lines),
+        n_lines,
+    )
+    x = exp_table[exp_fields[0]][lines].astype(np.int64)
+    y = exp_table[exp_fields[1]][lines].astype(np.int64)
+    counts = exp_table[exp_fields[2]][lines]
+
+    y_offset = y - y.min()
+    spot_codes, _ = pd.factorize(x * (y_offset.max() + 1) + y_offset)
+    first_line = np.unique(spot_codes, return_index=True)[1]
+    spots = pd.Index(
+        [f"{i}x{j}" for i, j in zip(x[first_line], y[first_line])])
+    genes = pd.Index([i.decode("utf8") for i in gene_table[gene_fields[0]]])
+
+    return _long_to_dataset(spot_codes, spots, gene_codes, genes, x, y, counts)
@@ -1,35 +1,47 @@
 from __future__ import annotations
 
-from functools import partial
-from multiprocessing import Pool, cpu_count
-from typing import Tuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count, shared_memory
+from typing import Dict, Optional, Tuple, Union
 
 import numba
+import numpy as np
 import pandas as pd
 from libpysal.weights import W as libpysal_W
-from pysal.explore import esda
+from scipy import sparse, stats
+
+from . import _moran_numba
+from .utils import df_to_spmatrix, sparse_mean_std
+from .weights import KNNW
 
 
 def local_moran(
     gene_expression_df: pd.DataFrame,
-    weights: libpysal_W,
+    weights: Union[libpysal_W, KNNW],
     transformation: str = 'r',
     permutation: int = 999,
     cores: int = cpu_count(),
+    seed: Optional[int] = None,
+    z_threshold: Optional[float] = None,
+    check_every: Optional[int] = None,
 ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """
     Calculate local moran for hotspot identification.
 
+    All genes are evaluated at once: spatial lags come from one sparse-dense
+    product and pseudo p-values from conditional randomization, where the
+    same permuted neighbor ids are shared by every spot and every gene.
+
     Parameters
     ==========
     gene_expression_df : pd.DataFrame
        Expression matrix for Spatial Transcriptomics Data.
 
-    weights : libpysal.weights.W
+    weights : libpysal.weights.W or KNNW
         Spatial weight for calculating Moran's I.
 
     transformation : str, default 'r'
-        Weights transformation passed to esda.moran.Moran_Local
+        Weights transformation applied before calculation.
 
     permutation : int, default 999
         Number of random permutations for calculation of pseudo-p_values.
@@ -37,6 +49,19 @@ def local_moran(
     cores : int
         Number of threads to run svgbit. Use all available cpus by default.
 
+    seed : int or None, default None
+        Seed for conditional randomization.
+
+    z_threshold : float or None, default None
+        If given, only cells whose analytic z-score of local Moran's I is
+        greater than z_threshold in absolute value are permuted, p values
+        of other cells come from the normal approximation.
+
+    check_every : int or None, default None
+        If given, permutations of a cell stop early once the 95% confidence
+        interval of its pseudo p value, checked every check_every
+        permutations, excludes 0.05.
+
     Returns
     =======
     hotspot : pd.DataFrame
@@ -49,99 +74,324 @@ def local_moran(
         Local Moran's I p values.
 
     """
-    partial_func = partial(
-        _local_moran,
-        weights=weights,
+    hotspot, i_value, p_value = _local_moran(
+        df_to_spmatrix(gene_expression_df),
+        weights,
         transformation=transformation,
         permutation=permutation,
+        cores=cores,
+        seed=seed,
+        z_threshold=z_threshold,
+        check_every=check_every,
     )
-    pool = Pool(processes=cores)
-    result_lists = pool.map(
-        partial_func,
-        [gene_expression_df[i] for i in gene_expression_df.columns],
-    )
-    pool.close()
-    pool.join()
-    hotspot = pd.concat([i[0] for i in result_lists], axis=1)
-    i_value = pd.concat([i[1] for i in result_lists], axis=1)
-    p_value = pd.concat([i[2] for i in result_lists], axis=1)
+
+    spots = gene_expression_df.index
+    genes = gene_expression_df.columns
+    hotspot = pd.DataFrame(1 * hotspot, index=spots, columns=genes)
+    i_value = pd.DataFrame(i_value, index=spots, columns=genes)
+    p_value = pd.DataFrame(p_value, index=spots, columns=genes)
 
     return hotspot, i_value, p_value
 
 
 def _local_moran(
-    gene_expression_series: pd.Series,
-    weights: libpysal_W,
-    transformation: str = "r",
+    X: sparse.spmatrix,
+    weights: Union[libpysal_W, KNNW],
+    transformation: str = 'r',
     permutation: int = 999,
-) -> Tuple[pd.Series, pd.Series, pd.Series]:
+    cores: int = cpu_count(),
+    seed: Optional[int] = None,
+    z_threshold: Optional[float] = None,
+    check_every: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Calculate local moran for hotspot identification for a single gene.
+    Calculate local moran for hotspot identification on a count matrix.
 
     Parameters
     ==========
-    gene_expression_series : pd.Series
-       Expression series for Spatial Transcriptomics Data.
+    X : scipy.sparse.spmatrix
+       Expression matrix (n_spots * n_genes).
 
-    weights : libpysal.weights.W
+    weights : libpysal.weights.W or KNNW
         Spatial weight for calculating Moran's I.
 
     transformation : str, default 'r'
-        Weights transformation passed to esda.moran.Moran_Local
+        Weights transformation applied before calculation.
 
     permutation : int, default 999
         Number of random permutations for calculation of pseudo-p_values.
 
+    cores : int
+        Number of threads to run svgbit. Use all available cpus by default.
+
+    seed : int or None, default None
+        Seed for conditional randomization.
+
+    z_threshold : float or None, default None
+        If given, only cells whose analytic z-score of local Moran's I is
+        greater than z_threshold in absolute value are permuted, p values
+        of other cells come from the normal approximation.
+
+    check_every : int or None, default None
+        If given, permutations of a cell stop early once the 95% confidence
+        interval of its pseudo p value, checked every check_every
+        permutations, excludes 0.05.
+
     Returns
     =======
-    hotspot : pd.DataFrame
-        Identified hotspots.
+    hotspot : np.ndarray
+        Boolean hotspot matrix in Fortran order.
 
-    i_value : pd.DataFrame
-        Local Moran's I values.
+    i_value : np.ndarray
+        Local Moran's I values in Fortran order.
 
-    p_value : pd.DataFrame
-        Local Moran's I p values.
+    p_value : np.ndarray
+        Local Moran's I p values in Fortran order.
 
     """
-    gene = gene_expression_series.name
-    spots = gene_expression_series.index
-    numba.config.THREADING_LAYER = "workqueue"
-    gene_lisa = esda.moran.Moran_Local(
-        gene_expression_series,
-        weights,
-        transformation=transformation,
-        permutations=permutation,
-        n_jobs=1,
+    X = sparse.csc_matrix(X, dtype=np.float64)
+    n = X.shape[0]
+
+    # keep the caller's weights untouched, density relies on binary knn
+    original_transformation = weights.transform
+    weights.transform = transformation
+    w_sparse = weights.sparse.tocsr()
+    weights.transform = original_transformation
+
+    mean, sd = sparse_mean_std(X)
+    sd[sd == 0] = 1
+    z = X.toarray()
+    z -= mean
+    z /= sd
+    den = (z * z).sum(axis=0)
+    den[den == 0] = 1
+    scaling = (n - 1) / den
+
+    if (z_threshold is None and check_every is None
+            and isinstance(weights, KNNW)
+            and w_sparse.data.min() == w_sparse.data.max()):
+        # fixed k and uniform weights: lags, permutations and hotspots
+        # are computed in one pass by a kernel specialized on k
+        numba.set_num_threads(
+            max(1, min(cores, numba.config.NUMBA_NUM_THREADS)))
+        hotspot, p_sim, ei_sim = _moran_numba.fused_moran_hotspot(weights.k)(
+            z,
+            weights.neighbors,
+            float(w_sparse.data[0]),
+            scaling,
+            _permuted_ids(n, weights.k, permutation, seed),
+        )
+    else:
+        lag = np.asarray(w_sparse @ z)
+        observed = z * lag * scaling
+
+        # select the significant hotspots (p < 0.05) in High-High quadrant
+        p_sim, ei_sim = _crand(
+            z,
+            w_sparse,
+            observed,
+            scaling,
+            permutation=permutation,
+            cores=cores,
+            seed=seed,
+            z_threshold=z_threshold,
+            check_every=check_every,
+        )
+        hotspot = (p_sim < 0.05) & (z > 0) & (lag > 0)
+    hotspot[:, hotspot.all(axis=0)] = False
+
+    return (
+        np.asfortranarray(hotspot),
+        np.asfortranarray(ei_sim, dtype=np.float32),
+        np.asfortranarray(p_sim, dtype=np.float32),
     )
-    # select the significant hotspots (p < 0.05)
-    local_moran_hotspot = 1 * ((gene_lisa.p_sim < 0.05) & (gene_lisa.q == 1))
 
-    hotspot = pd.Series(
-        local_moran_hotspot,
-        index=spots,
-        name=gene,
-    )
-    if (hotspot == 1).all():
-        hotspot = 0
 
-    i_value = pd.Series(
-        gene_lisa.EI_sim,
-        index=spots,
-        name=gene,
+def _permuted_ids(
+    n: int,
+    max_card: int,
+    permutation: int = 999,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Draw random neighbor ids shared by all spots for conditional randomization.
+
+    Parameters
+    ==========
+    n : int
+        Number of spots.
+
+    max_card : int
+        Max number of neighbors of a spot.
+
+    permutation : int, default 999
+        Number of random permutations.
+
+    seed : int or None, default None
+        Seed for conditional randomization.
+
+    Returns
+    =======
+    permuted_ids : np.ndarray
+        Ids (permutation * max_card) drawn without replacement from n - 1
+        spots, ids not less than i stand for id + 1 for spot i.
+
+    """
+    rng = np.random.default_rng(seed)
+    permuted_ids = np.empty((permutation, max_card), dtype=np.int64)
+    for p in range(permutation):
+        permuted_ids[p] = rng.choice(n - 1, size=max_card, replace=False)
+    return permuted_ids
+
+
+def _crand(
+    z: np.ndarray,
+    w_sparse: sparse.csr_matrix,
+    observed: np.ndarray,
+    scaling: np.ndarray,
+    permutation: int = 999,
+    cores: int = cpu_count(),
+    seed: Optional[int] = None,
+    z_threshold: Optional[float] = None,
+    check_every: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Conditional randomization of local Moran's I for all genes.
+
+    Parameters
+    ==========
+    z : np.ndarray
+        Standardized expression matrix (n_spots * n_genes).
+
+    w_sparse : scipy.sparse.csr_matrix
+        Transformed spatial weight.
+
+    observed : np.ndarray
+        Observed local Moran's I (n_spots * n_genes).
+
+    scaling : np.ndarray
+        Scaling factor of each gene.
+
+    permutation : int, default 999
+        Number of random permutations for calculation of pseudo-p_values.
+
+    cores : int
+        Number of threads to run svgbit. Use all available cpus by default.
+
+    seed : int or None, default None
+        Seed for conditional randomization.
+
+    z_threshold : float or None, default None
+        If given, only cells whose analytic z-score is greater than
+        z_threshold in absolute value are permuted.
+
+    check_every : int or None, default None
+        If given, permutations of a cell stop early once the confidence
+        interval of its pseudo p value excludes 0.05.
+
+    Returns
+    =======
+    p_sim : np.ndarray
+        Pseudo p values from conditional randomization.
+
+    ei_sim : np.ndarray
+        Average local Moran's I of permutations.
+
+    """
+    n, n_genes = z.shape
+    self_weights = w_sparse.diagonal()
+    other = (w_sparse - sparse.diags(self_weights)).tocsr()
+    other.eliminate_zeros()
+    cardinalities = np.diff(other.indptr)
+    max_card = cardinalities.max()
+
+    permuted_ids = _permuted_ids(n, max_card, permutation, seed)
+
+    numba.set_num_threads(max(1, min(cores, numba.config.NUMBA_NUM_THREADS)))
+    args = (
+        np.ascontiguousarray(z),
+        np.ascontiguousarray(observed),
+        scaling,
+        self_weights.astype(np.float64),
+        other.indptr.astype(np.int64),
+        other.data.astype(np.float64),
+        permuted_ids,
     )
-    p_value = pd.Series(
-        gene_lisa.p_sim,
-        index=spots,
-        name=gene,
+    if z_threshold is None and check_every is None:
+        return _moran_numba.crand(*args)
+
+    if z_threshold is None:
+        active = np.ones((n, n_genes), dtype=bool)
+        p_sim = np.empty((n, n_genes), dtype=np.float64)
+        ei_sim = np.empty((n, n_genes), dtype=np.float64)
+    else:
+        ei_sim, var_i = _crand_moments(z, self_weights, other, scaling)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z_i = (observed - ei_sim) / np.sqrt(var_i)
+        # cells without variance are left to the permutations
+        active = ~(np.abs(z_i) <= z_threshold)
+        p_sim = stats.norm.sf(np.abs(z_i))
+    _moran_numba.crand_cells(
+        *args,
+        active,
+        p_sim,
+        ei_sim,
+        check_every or 0,
     )
 
-    return hotspot, i_value, p_value
+    return p_sim, ei_sim
+
+
+def _crand_moments(
+    z: np.ndarray,
+    self_weights: np.ndarray,
+    other: sparse.csr_matrix,
+    scaling: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Mean and variance of local Moran's I under conditional randomization.
+
+    Neighbors of spot i are drawn without replacement from the other n - 1
+    spots, whose values have mean -z_i / (n - 1) since z is centered.
+
+    Parameters
+    ==========
+    z : np.ndarray
+        Standardized expression matrix (n_spots * n_genes).
+
+    self_weights : np.ndarray
+        Self weight of each spot.
+
+    other : scipy.sparse.csr_matrix
+        Transformed spatial weight without self weights.
+
+    scaling : np.ndarray
+        Scaling factor of each gene.
+
+    Returns
+    =======
+    ei : np.ndarray
+        Expected local Moran's I (n_spots * n_genes).
+
+    var_i : np.ndarray
+        Variance of local Moran's I (n_spots * n_genes).
+
+    """
+    n = z.shape[0]
+    wi = np.asarray(other.sum(axis=1))
+    wi2 = np.asarray(other.power(2).sum(axis=1))
+    z2 = z * z
+    mean_j = -z / (n - 1)
+    var_j = ((z2.sum(axis=0) - z2) / (n - 1) - mean_j**2).clip(min=0)
+    var_lag = var_j * (wi2 - (wi**2 - wi2) / max(n - 2, 1))
+    ei = z * scaling * (self_weights[:, None] * z + mean_j * wi)
+    var_i = z2 * scaling**2 * var_lag
+    return ei, var_i
 
 
 def global_moran(
         gene_expression_df: pd.DataFrame,
-        weights: libpysal_W,
+        weights: Union[libpysal_W, KNNW],
         transformation: str = 'r',
         permutation: int = 999,
         cores: int = cpu_count(),
@@ -154,11 +404,11 @@ def global_moran(
     gene_expression_df : pd.DataFrame
        Expression matrix for Spatial Transcriptomics Data.
 
-    weights : libpysal.weights.W
+    weights : libpysal.weights.W or KNNW
         Spatial weight for calculating Moran's I.
 
     transformation : str, default 'r'
-        Weights transformation passed to esda.moran.Moran
+        Weights transformation applied before calculation.
 
     permutation : int, default 999
         Number of random permutations for calculation of pseudo-p_values.
@@ -172,86 +422,199 @@ def global_moran(
         Global Moran's I result.
 
     """
-    partial_func = partial(
-        _global_moran,
-        weights=weights,
-        transformation=transformation,
-        permutation=permutation,
+    # transform the weights once and ship them to workers as CSR, esda
+    # resets the cached sparse weights and moments of W on every gene
+    original_transformation = weights.transform
+    weights.transform = transformation
+    w_sparse = weights.sparse.tocsr()
+    weights.transform = original_transformation
+    w_sum = np.asarray(w_sparse.sum(axis=1)).ravel() + np.asarray(
+        w_sparse.sum(axis=0)).ravel()
+    moments = (
+        w_sparse.sum(),
+        (w_sparse + w_sparse.T).power(2).sum() / 2,
+        (w_sum**2).sum(),
     )
-    pool = Pool(processes=cores)
-    result_lists = pool.map(partial_func, gene_expression_df.columns)
-    pool.close()
-    pool.join()
-    result_df = pd.concat(result_lists, axis=0)
-
-    global_moran_df = result_df
-    global_moran_df.sort_values(
+
+    # Moran's I is invariant to standardization, do it once for all genes
+    X = df_to_spmatrix(gene_expression_df)
+    mean, sd = sparse_mean_std(X)
+    sd[sd == 0] = 1
+
+    # share the expression matrix with workers instead of pickling it,
+    # Fortran order makes every gene a contiguous column
+    shm = shared_memory.SharedMemory(
+        create=True,
+        size=max(1, X.shape[0] * X.shape[1] * X.dtype.itemsize),
+    )
+    values = np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf, order="F")
+    X.toarray(out=values)
+    values -= mean
+    values /= sd
+    try:
+        with ProcessPoolExecutor(
+                max_workers=cores,
+                initializer=_init_global_moran,
+                initargs=(
+                    shm.name,
+                    values.shape,
+                    values.dtype.str,
+                    w_sparse,
+                    moments,
+                    permutation,
+                ),
+        ) as executor:
+            n_genes = values.shape[1]
+            result_lists = list(
+                executor.map(
+                    _global_moran,
+                    range(n_genes),
+                    chunksize=max(1, n_genes // (cores * 4)),
+                ))
+    finally:
+        del values
+        shm.close()
+        shm.unlink()
+
+    global_moran_df = pd.DataFrame(
+        result_lists,
+        index=gene_expression_df.columns,
+        columns=[
+            'I_value',
+            'p_value_sim',
+            'p_value_rand',
+            'p_value_z_sim',
+            'p_value_norm',
+        ],
+    )
+    global_moran_df = global_moran_df.sort_values(
         by="p_value_sim",
-        inplace=False,
         ascending=True,
     )
 
     return global_moran_df
 
 
-def _global_moran(
-    gene_expression_series: pd.Series,
-    weights: libpysal_W,
-    transformation: str = 'r',
+# per-process state of global_moran workers
+_global_moran_shared = {}
+
+
+def _init_global_moran(
+    shm_name: str,
+    shape: Tuple[int, int],
+    dtype: str,
+    w_sparse: sparse.csr_matrix,
+    moments: Tuple[float, float, float],
     permutation: int = 999,
-) -> pd.DataFrame:
+) -> None:
     """
-    Calculate global Moran's I value for a single gene.
+    Attach a global_moran worker to the shared expression matrix.
 
     Parameters
     ==========
-    gene_expression_series : pd.Series
-       Expression series for Spatial Transcriptomics Data.
+    shm_name : str
+        Name of the shared memory block holding the expression matrix.
 
-    weights : libpysal.weights.W
-        Spatial weight for calculating Moran's I.
+    shape : tuple
+        Shape of the Fortran ordered expression matrix (n_spots * n_genes).
 
-    transformation : str, default 'r'
-        Weights transformation passed to esda.moran.Moran
+    dtype : str
+        Dtype of the expression matrix.
+
+    w_sparse : scipy.sparse.csr_matrix
+        Transformed spatial weight.
+
+    moments : tuple
+        ``(s0, s1, s2)`` of the transformed spatial weight.
 
     permutation : int, default 999
         Number of random permutations for calculation of pseudo-p_values.
 
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _global_moran_shared["shm"] = shm
+    _global_moran_shared["values"] = np.ndarray(
+        shape,
+        dtype=np.dtype(dtype),
+        buffer=shm.buf,
+        order="F",
+    )
+    _global_moran_shared["w_sparse"] = w_sparse
+    _global_moran_shared["moments"] = moments
+    _global_moran_shared["permutation"] = permutation
+
+
+def _global_moran(gene_idx: int) -> Dict[str, float]:
+    """
+    Calculate global Moran's I value for a single gene.
+
+    Statistics follow ``esda.moran.Moran`` with two-tailed analytical
+    p values.
+
+    Parameters
+    ==========
+    gene_idx : int
+        Position of the gene in the shared expression matrix.
+
     Returns
     =======
-    global_moran_df : pd.DataFrame
+    global_moran_dict : dict
         Global Moran's I result.
 
     """
-    gene = gene_expression_series.name
-    global_moran_df = pd.DataFrame(
-        columns=[
-            'I_value',
-            'p_value_sim',
-            'p_value_rand',
-            'p_value_z_sim',
-            'p_value_norm',
-        ],
-        index=[gene],
-    )
-    moran_value = esda.moran.Moran(
-        gene_expression_series,
-        weights,
-        transformation=transformation,
-        permutations=permutation,
-    )
-    p_value_sim = moran_value.p_sim
-    moranI = moran_value.I
-    p_value_norm = moran_value.p_norm
-    p_value_rand = moran_value.p_rand
-    p_value_z_sim = moran_value.p_z_sim
-    global_moran_df['p_value_sim'][gene] = p_value_sim
-    global_moran_df['I_value'][gene] = moranI
-    global_moran_df['p_value_rand'][gene] = p_value_rand
-    global_moran_df['p_value_z_sim'] = p_value_z_sim
-    global_moran_df['p_value_norm'] = p_value_norm
-
-    return global_moran_df
+    w_sparse = _global_moran_shared["w_sparse"]
+    s0, s1, s2 = _global_moran_shared["moments"]
+    permutation = _global_moran_shared["permutation"]
+    y = _global_moran_shared["values"][:, gene_idx]
+
+    n = len(y)
+    z = y - y.mean()
+    z2ss = (z * z).sum()
+    I_value = n / s0 * (z * (w_sparse @ z)).sum() / z2ss
+
+    # moments under normality and randomization
+    EI = -1.0 / (n - 1)
+    n2 = n * n
+    s02 = s0 * s0
+    VI_norm = ((n2 * s1 - n * s2 + 3 * s02) / ((n - 1) * (n + 1) * s02) -
+               (1.0 / (n - 1))**2)
+    k = ((z**4).sum() / n) / ((z**2).sum() / n)**2
+    A = n * ((n2 - 3 * n + 3) * s1 - n * s2 + 3 * s02)
+    B = k * ((n2 - n) * s1 - 2 * n * s2 + 6 * s02)
+    VI_rand = (A - B) / ((n - 1) * (n - 2) * (n - 3) * s02) - EI * EI
+    z_norm = (I_value - EI) / VI_norm**0.5
+    z_rand = (I_value - EI) / VI_rand**0.5
+    if z_norm > 0:
+        p_norm = 2 * stats.norm.sf(z_norm)
+        p_rand = 2 * stats.norm.sf(z_rand)
+    else:
+        p_norm = 2 * stats.norm.cdf(z_norm)
+        p_rand = 2 * stats.norm.cdf(z_rand)
+
+    # same draws from the global numpy RNG as esda
+    sim = np.empty(permutation)
+    for p in range(permutation):
+        permuted = np.random.permutation(z)
+        sim[p] = n / s0 * (permuted * (w_sparse @ permuted)).sum() / z2ss
+    larger = (sim >= I_value).sum()
+    larger = min(larger, permutation - larger)
+    p_sim = (larger + 1.0) / (permutation + 1.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z_sim = (I_value - sim.mean()) / sim.std()
+    if z_sim > 0:
+        p_z_sim = stats.norm.sf(z_sim)
+    else:
+        p_z_sim = stats.norm.cdf(z_sim)
+
+    global_moran_dict = {
+        'I_value': I_value,
+        'p_value_sim': p_sim,
+        'p_value_rand': p_rand,
+        'p_value_z_sim': p_z_sim,
+        'p_value_norm': p_norm,
+    }
+
+    return global_moran_dict
 
 
 if __name__ == "__main__":
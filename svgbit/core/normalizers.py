@@ -1,14 +1,18 @@
 from __future__ import annotations
 
-from numpy import log as nlog
-from pandas import SparseDtype
+from typing import Union
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
 
 from .STDataset import STDataset
+from .utils import df_to_spmatrix
 
 
-def cpm_normalizer(dataset: STDataset) -> STDataset:
+def _cpm_matrix(dataset: STDataset) -> Union[sparse.csc_matrix, np.ndarray]:
     """
-    Perform CPM on dataset.
+    Scale counts of every spot to 10000.
 
     Parameters
     ==========
@@ -17,29 +21,82 @@ def cpm_normalizer(dataset: STDataset) -> STDataset:
 
     Returns
     =======
-    dataset : STDataset
-        A new STDataset instance with normalized expression matrix.
+    scale_mat : scipy.sparse.csc_matrix or np.ndarray
+        Scaled float32 expression matrix (n_spots * n_genes), sparse if
+        count_df of dataset is sparse.
 
     """
-    try:
-        count_df = dataset.count_df.sparse.to_dense()
-    except AttributeError:
-        pass
-    try:
-        scale_df = (count_df.T * 10000 / count_df.T.sum())
-    except AttributeError:
-        pass
+    # values are stored as float32, so scale in float32 and sum in float64
+    if dataset._is_sparse:
+        scale_mat = df_to_spmatrix(dataset.count_df, dtype=np.float32)
+        spot_sum = np.asarray(
+            scale_mat.sum(axis=1, dtype=np.float64)).ravel()
+    else:
+        scale_mat = dataset.count_df.to_numpy(dtype=np.float32, copy=True)
+        spot_sum = scale_mat.sum(axis=1, dtype=np.float64)
+    # spots without counts stay 0
+    scale = np.divide(
+        10000,
+        spot_sum,
+        out=np.zeros_like(spot_sum),
+        where=spot_sum > 0,
+    ).astype(np.float32)
+    if sparse.issparse(scale_mat):
+        scale_mat.data *= scale[scale_mat.indices]
+    else:
+        # broadcast over genes, no transposed copies
+        scale_mat *= scale[:, np.newaxis]
+    return scale_mat
+
+
+def _normalized_dataset(
+    dataset: STDataset,
+    scale_mat: Union[sparse.csc_matrix, np.ndarray],
+    normalizer: str,
+) -> STDataset:
+    """Wrap a normalized expression matrix into a new STDataset."""
+    if sparse.issparse(scale_mat):
+        scale_df = pd.DataFrame.sparse.from_spmatrix(
+            scale_mat,
+            index=dataset.count_df.index,
+            columns=dataset.count_df.columns,
+        )
+    else:
+        scale_df = pd.DataFrame(
+            scale_mat,
+            index=dataset.count_df.index,
+            columns=dataset.count_df.columns,
+        )
     return_dset = STDataset(
-        scale_df.T,
+        scale_df,
         dataset.coordinate_df,
+        make_sparse=sparse.issparse(scale_mat),
         check_duplicate_genes=False,
         sort_spots=False,
     )
-    return_dset._normalizer = "cpm"
+    return_dset._normalizer = normalizer
     return_dset._array_coordinate = dataset._array_coordinate
     return return_dset
 
 
+def cpm_normalizer(dataset: STDataset) -> STDataset:
+    """
+    Perform CPM on dataset.
+
+    Parameters
+    ==========
+    dataset : STDataset
+        STDataset to be normalized.
+
+    Returns
+    =======
+    dataset : STDataset
+        A new STDataset instance with normalized expression matrix.
+
+    """
+    return _normalized_dataset(dataset, _cpm_matrix(dataset), "cpm")
+
+
 def logcpm_normalizer(dataset: STDataset) -> STDataset:
     """
     Perform logcpm on dataset.
@@ -55,17 +112,8 @@ def logcpm_normalizer(dataset: STDataset) -> STDataset:
         A new STDataset instance with normalized expression matrix.
 
     """
-    try:
-        count_df = dataset.count_df.sparse.to_dense()
-    except AttributeError:
-        pass
-    scale_df = nlog(count_df.T * 10000 / count_df.T.sum() + 1)
-    return_dset = STDataset(
-        scale_df.T,
-        dataset.coordinate_df,
-        check_duplicate_genes=False,
-        sort_spots=False,
-    )
-    return_dset._normalizer = "logcpm"
-    return_dset._array_coordinate = dataset._array_coordinate
-    return return_dset
+    scale_mat = _cpm_matrix(dataset)
+    # log(x + 1) keeps zeros, only stored values of sparse matrix change
+    values = scale_mat.data if sparse.issparse(scale_mat) else scale_mat
+    np.log1p(values, out=values)
+    return _normalized_dataset(dataset, scale_mat, "logcpm")
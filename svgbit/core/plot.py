@@ -1,18 +1,193 @@
 from __future__ import annotations
 
+from concurrent.futures import ProcessPoolExecutor
 from itertools import combinations
 from math import ceil
+from multiprocessing import cpu_count
 from pathlib import Path
-from typing import Optional, Union, List
+from typing import Optional, Union, List, Tuple
 
 import matplotlib as mpl
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 from PIL import Image
-from scipy.special import comb
 
 from .STDataset import STDataset
-from .utils import get_cmap
+from .utils import agg_figure, get_cmap
+
+
+def _load_he_image(
+    he_image: Optional[Union[str, Path, Image.Image]],
+    dpi: float = 300,
+    axes_scale: float = 1,
+) -> Tuple[Optional[np.ndarray], Optional[Tuple[float, float, float, float]],
+           Tuple[float, float]]:
+    """
+    Decode H&E image into an array drawn by ``imshow``.
+
+    Images larger than the axes are downscaled to its pixel size before
+    drawing, ``extent`` keeps them in pixel coordinates of the original
+    image, where spots are placed.
+
+    Parameters
+    ==========
+    he_image : str, pathlib.Path, PIL.Image.Image or None
+        H&E image of tissue. Image files are opened, decoded and closed.
+
+    dpi : float, default 300
+        DPI of the figure.
+
+    axes_scale : float, default 1
+        Size of axes drawing the image, as a fraction of the figure size.
+
+    Returns
+    =======
+    he_array : np.ndarray or None
+        Decoded image, None if he_image is None.
+
+    extent : tuple or None
+        ``extent`` of he_array for ``imshow``.
+
+    figsize : tuple
+        Figure size, following aspect ratio of image files.
+    """
+    figsize = (10, 10)
+    if he_image is None:
+        return None, None, figsize
+    if isinstance(he_image, Image.Image):
+        size = (figsize[0] * axes_scale, figsize[1] * axes_scale)
+        return (*_fit_he_image(he_image, size, dpi), figsize)
+    with Image.open(he_image) as image:
+        figsize = (10, image.height / image.width * 10)
+        size = (figsize[0] * axes_scale, figsize[1] * axes_scale)
+        return (*_fit_he_image(image, size, dpi, draft=True), figsize)
+
+
+def _fit_he_image(
+    image: Image.Image,
+    axes_size: Tuple[float, float],
+    dpi: float,
+    draft: bool = False,
+) -> Tuple[np.ndarray, Tuple[float, float, float, float]]:
+    """Downscale image to pixel size of axes, see ``_load_he_image``."""
+    width, height = image.size
+    extent = (-0.5, width - 0.5, height - 0.5, -0.5)
+    size = (ceil(axes_size[0] * dpi), ceil(axes_size[1] * dpi))
+    if draft:
+        # JPEG files are decoded at a reduced scale directly
+        image.draft(image.mode, size)
+    scale = min(size[0] / image.width, size[1] / image.height)
+    if scale < 1:
+        image = image.resize(
+            (
+                max(1, round(image.width * scale)),
+                max(1, round(image.height * scale)),
+            ),
+            Image.Resampling.BILINEAR,
+        )
+    return mpl.image.pil_to_array(image), extent
+
+
+def _agg_or_scatter(
+    ax: mpl.axes.Axes,
+    x: np.ndarray,
+    y: np.ndarray,
+    c: np.ndarray,
+    s: float,
+    cmap: str,
+    vmin: Optional[float],
+    vmax: Optional[float],
+    dpi: float,
+    figsize: Tuple[float, float],
+) -> mpl.cm.ScalarMappable:
+    """
+    Draw colored spots, aggregated into pixels when they are too dense.
+
+    If there are more spots than a quarter of the pixels of the axes, most
+    spots only overdraw each other. Spots are then binned into a pixel
+    grid and the mean value of every pixel is shown as an image, otherwise
+    spots are drawn by ``ax.scatter``.
+
+    Parameters
+    ==========
+    ax : matplotlib.axes.Axes
+        Axes to draw on.
+
+    x, y : np.ndarray
+        Coordinates of spots.
+
+    c : np.ndarray
+        Values of spots.
+
+    s : float
+        Spot size.
+
+    cmap, vmin, vmax
+        Colormap and its range of values.
+
+    dpi : float
+        DPI of figure.
+
+    figsize : tuple
+        Size of the axes in inches.
+
+    Returns
+    =======
+    mappable : matplotlib.cm.ScalarMappable
+        Drawn spots, a PathCollection or an AxesImage.
+    """
+    bins = (ceil(figsize[0] * dpi), ceil(figsize[1] * dpi))
+    if len(x) > 0.25 * bins[0] * bins[1]:
+        image, extent = _binned_mean(x, y, c, bins)
+        # keep the view set by an H&E image drawn before, the extent of
+        # binned spots would reset its inverted y axis and crop it
+        view = (ax.get_xlim(), ax.get_ylim()) if ax.images else None
+        mappable = ax.imshow(
+            image,
+            origin="lower",
+            extent=extent,
+            aspect="auto",
+            interpolation="nearest",
+            cmap=cmap,
+            vmin=vmin,
+            vmax=vmax,
+            alpha=0.7,
+            # above H&E image as spots would be
+            zorder=1,
+        )
+        if view is not None:
+            ax.set_xlim(view[0])
+            ax.set_ylim(view[1])
+        return mappable
+    return ax.scatter(
+        x,
+        y,
+        c=c,
+        cmap=cmap,
+        vmin=vmin,
+        vmax=vmax,
+        s=s,
+        alpha=0.7,
+        rasterized=True,
+    )
+
+
+def _binned_mean(
+    x: np.ndarray,
+    y: np.ndarray,
+    c: np.ndarray,
+    bins: Tuple[int, int],
+) -> Tuple[np.ndarray, list]:
+    """
+    Mean values of spots in every pixel of a (bins[1] * bins[0]) image, and
+    its extent. Pixels without spots are NaN.
+    """
+    total, x_edges, y_edges = np.histogram2d(x, y, bins=bins, weights=c)
+    count, _, _ = np.histogram2d(x, y, bins=bins)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        image = np.where(count > 0, total / count, np.nan)
+    extent = [x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]]
+    return image.T, extent
 
 
 def _svg_heatmap(
@@ -67,18 +242,32 @@ def _svg_heatmap(
     spacing, cluster_width = 0.03, 0.22
     rect_heatmap = [left + spacing, bottom + spacing * 2, width, height]
 
-    he_close = False
-    figsize = (10, 10)
-    if he_image is not None:
-        if not isinstance(he_image, Image.Image):
-            he_close = True
-            he_image = Image.open(he_image)
-            figsize = (10, he_image.height / he_image.width * 10)
+    # H&E image is only drawn in the small cluster maps
+    he_image, he_extent, figsize = _load_he_image(he_image, dpi, cluster_width)
 
-    fig = plt.figure(figsize=figsize, dpi=dpi)
+    fig = agg_figure(figsize=figsize, dpi=dpi)
     ax_heatmap = fig.add_axes(rect_heatmap)
 
-    for i, j in enumerate(set(cluster_result.values)):
+    # all cluster maps share the same spot positions
+    x = coordinate_df.iloc[:, 0].to_numpy()
+    y = coordinate_df.iloc[:, 1].to_numpy()
+
+    # hotspot ratio of each cluster in every spot, genes sorted by cluster
+    # are reduced at once
+    # 0/1 hotspots plotted as bytes, a no-op for hotspot_df of STDataset
+    svg_hotspot = hotspot_df[cluster_result.index].to_numpy(dtype=np.uint8)
+    labels, inverse = np.unique(cluster_result.to_numpy(), return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    cluster_sum = np.add.reduceat(
+        svg_hotspot[:, order],
+        np.searchsorted(inverse[order], np.arange(len(labels))),
+        axis=1,
+        dtype=np.float64,
+    )
+    cluster_size = np.bincount(inverse)
+    cluster_mean = dict(zip(labels, (cluster_sum / cluster_size).T))
+
+    for i, j in enumerate(labels):
         rect_cluster = [
             left + width + spacing * (2 + i // 3) + cluster_width * (i // 3),
             bottom + spacing * (3 - i % 3) + cluster_width * (2 - i % 3),
@@ -89,20 +278,23 @@ def _svg_heatmap(
         ax_cluster.set_title(f"Cluster {j} hotspot distribution")
         ax_cluster.set_xticks([])
         ax_cluster.set_yticks([])
-        ax_cluster.imshow(he_image) if he_image is not None else None
+        if he_image is not None:
+            ax_cluster.imshow(he_image, extent=he_extent)
         ax_cluster.axis("off")
-        sc = ax_cluster.scatter(
-            coordinate_df.iloc[:, 0],
-            coordinate_df.iloc[:, 1],
-            c=hotspot_df[cluster_result[cluster_result == j].index].T.mean(),
+        sc = _agg_or_scatter(
+            ax_cluster,
+            x,
+            y,
+            cluster_mean[j],
+            s=s,
             cmap="autumn_r",
             vmin=0,
             vmax=1,
-            s=s,
-            alpha=0.7,
+            dpi=dpi,
+            figsize=(figsize[0] * cluster_width, figsize[1] * cluster_width),
         )
 
-    ii = ceil(len(set(cluster_result.values)) / 3)
+    ii = ceil(len(labels) / 3)
     rect_cb = [
         left + width + spacing * (ii + 2) + cluster_width * ii,
         bottom + spacing * 2,
@@ -112,19 +304,26 @@ def _svg_heatmap(
     ax_cb = fig.add_axes(rect_cb)
     fig.colorbar(sc, cax=ax_cb)
 
+    # spots in order of spot types, taken by position from SVG hotspots
+    spot_idx = hotspot_df.index.get_indexer(spot_type.index)
+    if (spot_idx < 0).any():
+        raise KeyError("Spots of spot_type not found in hotspot_df.")
     ax_heatmap.imshow(
-        hotspot_df.reindex(
-            index=spot_type.index,
-            columns=cluster_result.index,
-        ),
+        svg_hotspot[spot_idx],
         cmap="Reds",
         aspect="auto",
     )
 
-    flag = 0
-    for i in range(1, len(set(cluster_result.values))):
-        flag += len(cluster_result[cluster_result == i])
-        ax_heatmap.plot([flag, flag], [0, hotspot_df.shape[0] - 5])
+    # one collection for all cluster dividers, colored as separate lines
+    flags = np.cumsum(cluster_size)[:-1]
+    cycle = mpl.rcParams["axes.prop_cycle"].by_key()["color"]
+    ax_heatmap.vlines(
+        flags,
+        0,
+        hotspot_df.shape[0] - 5,
+        colors=[cycle[i % len(cycle)] for i in range(len(flags))],
+        capstyle="projecting",
+    )
 
     ax_heatmap.set_xticks([])
     ax_heatmap.set_yticks([])
@@ -134,8 +333,6 @@ def _svg_heatmap(
     if save_path is not None:
         fig.savefig(save_path, bbox_inches="tight")
 
-    he_image.close() if he_close else None
-
     return fig
 
 
@@ -184,44 +381,107 @@ def _hotspot_distribution_map(
     fig : matplotlib.figure.Figure
         A matplotlib.figure.Figure plot.
     """
-    he_close = False
-    figsize = (10, 10)
-    if he_image is not None:
-        if not isinstance(he_image, Image.Image):
-            he_close = True
-            he_image = Image.open(he_image)
-            figsize = (10, he_image.height / he_image.width * 10)
-
-    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
-
     cluster = int(cluster)
-
-    ax.set_title(f"Cluster {cluster} hotspot distribution")
-    ax.set_xticks([])
-    ax.set_yticks([])
-    ax.axis("off")
-    sc = ax.scatter(
-        coordinate_df.iloc[:, 0],
-        coordinate_df.iloc[:, 1],
-        c=hotspot_df[cluster_result[cluster_result == cluster].index].T.mean(),
-        cmap="autumn_r",
-        vmin=0,
-        vmax=1,
+    fig, _, _ = _hotspot_figure(
+        _cluster_hotspot_ratio(hotspot_df, cluster_result, cluster),
+        coordinate_df,
+        f"Cluster {cluster} hotspot distribution",
+        he_image=he_image,
         s=s,
-        alpha=0.7,
+        dpi=dpi,
     )
-    fig.colorbar(sc)
-
-    ax.imshow(he_image) if he_image is not None else None
 
     if save_path is not None:
         fig.savefig(save_path, bbox_inches="tight")
 
-    he_image.close() if he_close else None
-
     return fig
 
 
+def _hotspot_distribution_map_many(
+    hotspot_df: pd.DataFrame,
+    coordinate_df: pd.DataFrame,
+    cluster_result: pd.Series,
+    clusters: list,
+    save_dir: Union[str, Path],
+    he_image: Optional[Union[str, Path, Image.Image]] = None,
+    s: float = 4,
+    dpi: float = 300,
+    file_format: str = "jpg",
+    cores: int = cpu_count(),
+) -> List[Path]:
+    """
+    Draw and save hotspot distribution maps for multiple SVG clusters.
+
+    Parameters
+    ==========
+    hotspot_df : pd.DataFrame
+        A pd.DataFrame for hotspots.
+
+    coordinate_df : pd.DataFrame
+        A pd.DataFrame for coordinate files.
+
+    cluster_result : pd.Series
+        A pd.Series for cluster result.
+
+    clusters : list
+        Which clusters to draw.
+
+    save_dir : str or pathlib.Path
+        Directory to save figures, named ``cluster_{cluster}.{file_format}``.
+
+    he_image : str, pathlib.Path or PIL.Image.Image, default None
+        H&E image of tissue. If None is given (default), distribution map
+        will not show tissue picture.
+
+    s : float, default 4
+        Spot size.
+
+    dpi : float, default 300
+        DPI for saved figure.
+
+    file_format : str, default "jpg"
+        File format of saved figures.
+
+    cores : int
+        Number of processes to draw figures. Use all available cpus by
+        default.
+
+    Returns
+    =======
+    save_paths : list
+        Paths of saved figures.
+    """
+    clusters = [int(cluster) for cluster in clusters]
+    if not clusters:
+        return []
+    return _save_hotspot_figures(
+        np.column_stack([
+            _cluster_hotspot_ratio(hotspot_df, cluster_result, cluster)
+            for cluster in clusters
+        ]),
+        coordinate_df,
+        [f"Cluster {cluster} hotspot distribution" for cluster in clusters],
+        [
+            Path(save_dir).joinpath(f"cluster_{cluster}.{file_format}")
+            for cluster in clusters
+        ],
+        he_image=he_image,
+        s=s,
+        dpi=dpi,
+        cores=cores,
+    )
+
+
+def _cluster_hotspot_ratio(
+    hotspot_df: pd.DataFrame,
+    cluster_result: pd.Series,
+    cluster: int,
+) -> np.ndarray:
+    """Ratio of genes of an SVG cluster being hotspots in every spot."""
+    genes = cluster_result.index[cluster_result.to_numpy() == cluster]
+    return hotspot_df[genes].to_numpy(dtype=np.uint8).mean(axis=1)
+
+
 def _hotspot_expression(
     hotspot_df: pd.DataFrame,
     coordinate_df: pd.DataFrame,
@@ -263,40 +523,220 @@ def _hotspot_expression(
     fig : matplotlib.figure.Figure
         A matplotlib.figure.Figure plot.
     """
-    he_close = False
-    figsize = (10, 10)
-    if he_image is not None:
-        if not isinstance(he_image, Image.Image):
-            he_close = True
-            he_image = Image.open(he_image)
-            figsize = (10, he_image.height / he_image.width * 10)
+    fig, _, _ = _hotspot_figure(
+        hotspot_df[gene].to_numpy(),
+        coordinate_df,
+        gene,
+        he_image=he_image,
+        s=s,
+        dpi=dpi,
+    )
 
-    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
+    if save_path is not None:
+        fig.savefig(save_path, bbox_inches="tight")
 
-    ax.set_title(gene)
+    return fig
+
+
+def _hotspot_expression_many(
+    hotspot_df: pd.DataFrame,
+    coordinate_df: pd.DataFrame,
+    genes: list,
+    save_dir: Union[str, Path],
+    he_image: Optional[Union[str, Path, Image.Image]] = None,
+    s: float = 4,
+    dpi: float = 300,
+    file_format: str = "jpg",
+    cores: int = cpu_count(),
+) -> List[Path]:
+    """
+    Draw and save hotspot expression for multiple genes.
+
+    Genes are split into one chunk per process. In every process the
+    figure, H&E image and colorbar are drawn once, only colors of spots
+    and title change for every gene.
+
+    Parameters
+    ==========
+    hotspot_df : pd.DataFrame
+        A pd.DataFrame for hotspots.
+
+    coordinate_df : pd.DataFrame
+        A pd.DataFrame for coordinate files.
+
+    genes : list
+        Which genes to draw.
+
+    save_dir : str or pathlib.Path
+        Directory to save figures, named ``{gene}.{file_format}``.
+
+    he_image : str, pathlib.Path or PIL.Image.Image, default None
+        H&E image of tissue. If None is given (default), distribution map
+        will not show tissue picture.
+
+    s : float, default 4
+        Spot size.
+
+    dpi : float, default 300
+        DPI for saved figure.
+
+    file_format : str, default "jpg"
+        File format of saved figures.
+
+    cores : int
+        Number of processes to draw figures. Use all available cpus by
+        default.
+
+    Returns
+    =======
+    save_paths : list
+        Paths of saved figures.
+    """
+    return _save_hotspot_figures(
+        hotspot_df[genes].to_numpy(),
+        coordinate_df,
+        genes,
+        [Path(save_dir).joinpath(f"{gene}.{file_format}") for gene in genes],
+        he_image=he_image,
+        s=s,
+        dpi=dpi,
+        cores=cores,
+    )
+
+
+def _save_hotspot_figures(
+    value_mat: np.ndarray,
+    coordinate_df: pd.DataFrame,
+    titles: list,
+    save_paths: List[Path],
+    he_image: Optional[Union[str, Path, Image.Image]] = None,
+    s: float = 4,
+    dpi: float = 300,
+    cores: int = cpu_count(),
+) -> List[Path]:
+    """
+    Save one hotspot figure for every column of value_mat.
+
+    Columns are split into one chunk per process. In every process the
+    figure, H&E image and colorbar are drawn once, only colors of spots
+    and title change for every column.
+    """
+    if not titles:
+        return []
+    cores = max(1, min(cores, len(titles)))
+    if cores == 1:
+        return _save_hotspot_figures_chunk(
+            value_mat,
+            coordinate_df,
+            titles,
+            save_paths,
+            he_image,
+            s,
+            dpi,
+        )
+
+    # each process gets only values of its own figures
+    chunks = np.array_split(np.arange(len(titles)), cores)
+    with ProcessPoolExecutor(max_workers=cores) as executor:
+        futures = [
+            executor.submit(
+                _save_hotspot_figures_chunk,
+                value_mat[:, chunk],
+                coordinate_df,
+                [titles[i] for i in chunk],
+                [save_paths[i] for i in chunk],
+                he_image,
+                s,
+                dpi,
+            ) for chunk in chunks
+        ]
+        return [path for future in futures for path in future.result()]
+
+
+def _save_hotspot_figures_chunk(
+    value_mat: np.ndarray,
+    coordinate_df: pd.DataFrame,
+    titles: list,
+    save_paths: List[Path],
+    he_image: Optional[Union[str, Path, Image.Image]],
+    s: float,
+    dpi: float,
+) -> List[Path]:
+    """Draw columns of value_mat on one figure and save them."""
+    fig, ax, sc = _hotspot_figure(
+        value_mat[:, 0],
+        coordinate_df,
+        titles[0],
+        he_image=he_image,
+        s=s,
+        dpi=dpi,
+    )
+
+    if isinstance(sc, mpl.image.AxesImage):
+        x = coordinate_df.iloc[:, 0].to_numpy()
+        y = coordinate_df.iloc[:, 1].to_numpy()
+        bins = sc.get_array().shape[::-1]
+
+    # only colors and title change between figures, so the tight bounding
+    # box of all other artists is measured once instead of every savefig
+    renderer = fig.canvas.get_renderer()
+    fig.draw_without_rendering()
+    ax.title.set_visible(False)
+    other_bbox = fig.get_tightbbox(renderer)
+    ax.title.set_visible(True)
+    to_inches = fig.dpi_scale_trans.inverted()
+    pad_inches = mpl.rcParams["savefig.pad_inches"]
+
+    for i, (title, save_path) in enumerate(zip(titles, save_paths)):
+        if isinstance(sc, mpl.image.AxesImage):
+            sc.set_data(_binned_mean(x, y, value_mat[:, i], bins)[0])
+        else:
+            sc.set_array(value_mat[:, i])
+        ax.set_title(title)
+        bbox = mpl.transforms.Bbox.union([
+            other_bbox,
+            ax.title.get_window_extent(renderer).transformed(to_inches),
+        ])
+        fig.savefig(save_path, bbox_inches=bbox.padded(pad_inches))
+
+    return save_paths
+
+
+def _hotspot_figure(
+    values: np.ndarray,
+    coordinate_df: pd.DataFrame,
+    title: str,
+    he_image: Optional[Union[str, Path, Image.Image]] = None,
+    s: float = 4,
+    dpi: float = 300,
+) -> Tuple[mpl.figure.Figure, mpl.axes.Axes, mpl.cm.ScalarMappable]:
+    """Draw spots colored by values in [0, 1], return figure, axes, spots."""
+    he_image, he_extent, figsize = _load_he_image(he_image, dpi)
+
+    fig = agg_figure(figsize=figsize, dpi=dpi)
+    ax = fig.subplots()
+
+    ax.set_title(title)
     ax.set_xticks([])
     ax.set_yticks([])
     ax.axis("off")
-    sc = ax.scatter(
-        coordinate_df.iloc[:, 0],
-        coordinate_df.iloc[:, 1],
-        c=hotspot_df[gene],
+    sc = _agg_or_scatter(
+        ax,
+        coordinate_df.iloc[:, 0].to_numpy(),
+        coordinate_df.iloc[:, 1].to_numpy(),
+        values,
+        s=s,
         cmap="autumn_r",
         vmin=0,
         vmax=1,
-        s=s,
-        alpha=0.7,
+        dpi=dpi,
+        figsize=figsize,
     )
     fig.colorbar(sc)
 
-    ax.imshow(he_image) if he_image is not None else None
+    ax.imshow(he_image, extent=he_extent) if he_image is not None else None
 
-    if save_path is not None:
-        fig.savefig(save_path, bbox_inches="tight")
-
-    he_image.close() if he_close else None
-
-    return fig
+    return fig, ax, sc
 
 
 def _hotspot_colocalization_map(
@@ -344,15 +784,10 @@ def _hotspot_colocalization_map(
     fig : matplotlib.figure.Figure
         A matplotlib.figure.Figure plot.
     """
-    he_close = False
-    figsize = (10, 10)
-    if he_image is not None:
-        if not isinstance(he_image, Image.Image):
-            he_close = True
-            he_image = Image.open(he_image)
-            figsize = (10, he_image.height / he_image.width * 10)
+    he_image, he_extent, figsize = _load_he_image(he_image, dpi)
 
-    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
+    fig = agg_figure(figsize=figsize, dpi=dpi)
+    ax = fig.subplots()
 
     if colors is None:
         if len(genes) <= 3:
@@ -361,55 +796,65 @@ def _hotspot_colocalization_map(
                 "tab:cyan", "k"
             ]
         else:
-            i = len(genes)
-            n_colors = 0
-            while i > 0:
-                n_colors += comb(len(genes), i)
-                i -= 1
-            colors = get_cmap(n_colors)
+            # one color for every non-empty combination of genes
+            n_colors = (1 << len(genes)) - 1
+            colors = [
+                mpl.colors.to_hex(color)
+                for color in get_cmap(n_colors)(np.arange(n_colors))
+            ]
 
     ax.set_xticks([])
     ax.set_yticks([])
     ax.axis("off")
 
+    # hotspots of the genes in every spot packed into one uint64, spots of
+    # a combination are those with all of its bits set
+    if len(genes) > 64:
+        raise ValueError("At most 64 genes are supported.")
+    hotspot_mat = hotspot_df[genes].reindex(index=coordinate_df.index) == 1
+    packed = np.bitwise_or.reduce(
+        hotspot_mat.to_numpy(dtype=np.uint64) <<
+        np.arange(len(genes), dtype=np.uint64),
+        axis=1,
+    )
+    x = coordinate_df.iloc[:, 0].to_numpy()
+    y = coordinate_df.iloc[:, 1].to_numpy()
+
     for i, gene in enumerate(genes):
-        draw_counts = hotspot_df[gene].loc[hotspot_df[gene] == 1]
+        draw_spots = (packed >> np.uint64(i)) & np.uint64(1) == 1
         ax.scatter(
-            coordinate_df.iloc[:, 0].reindex(index=draw_counts.index),
-            coordinate_df.iloc[:, 1].reindex(index=draw_counts.index),
+            x[draw_spots],
+            y[draw_spots],
             s=s,
             color=colors[i],
             alpha=0.7,
+            rasterized=True,
             label=f"{gene}",
         )
 
     n_combinations = 2
     while n_combinations <= len(genes):
-        for c in combinations(genes, n_combinations):
+        for c in combinations(range(len(genes)), n_combinations):
             i += 1
-            draw_counts = pd.Series(index=coordinate_df.index, dtype=int)
-            draw_counts = draw_counts.fillna(0)
-            for gene in c:
-                draw_counts += hotspot_df[gene]
-            draw_counts = draw_counts[draw_counts == n_combinations]
+            mask = np.uint64(sum(1 << g for g in c))
+            draw_spots = packed & mask == mask
             ax.scatter(
-                coordinate_df.iloc[:, 0].reindex(index=draw_counts.index),
-                coordinate_df.iloc[:, 1].reindex(index=draw_counts.index),
+                x[draw_spots],
+                y[draw_spots],
                 c=colors[i],
                 s=s,
-                label=" & ".join(c),
+                label=" & ".join(genes[g] for g in c),
+                rasterized=True,
             )
         n_combinations += 1
 
     ax.legend(markerscale=2)
 
-    ax.imshow(he_image) if he_image is not None else None
+    ax.imshow(he_image, extent=he_extent) if he_image is not None else None
 
     if save_path is not None:
         fig.savefig(save_path, bbox_inches="tight")
 
-    he_image.close() if he_close else None
-
     return fig
 
 
@@ -454,37 +899,34 @@ def _gene_expression(
     fig : matplotlib.figure.Figure
         A matplotlib.figure.Figure plot.
     """
-    he_close = False
-    figsize = (10, 10)
-    if he_image is not None:
-        if not isinstance(he_image, Image.Image):
-            he_close = True
-            he_image = Image.open(he_image)
-            figsize = (10, he_image.height / he_image.width * 10)
+    he_image, he_extent, figsize = _load_he_image(he_image, dpi)
 
-    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
+    fig = agg_figure(figsize=figsize, dpi=dpi)
+    ax = fig.subplots()
 
     ax.set_title(gene)
     ax.set_xticks([])
     ax.set_yticks([])
     ax.axis("off")
-    sc = ax.scatter(
-        coordinate_df.iloc[:, 0],
-        coordinate_df.iloc[:, 1],
-        c=expression_df[gene],
-        cmap="autumn_r",
+    sc = _agg_or_scatter(
+        ax,
+        coordinate_df.iloc[:, 0].to_numpy(),
+        coordinate_df.iloc[:, 1].to_numpy(),
+        expression_df[gene].to_numpy(),
         s=s,
-        alpha=0.7,
+        cmap="autumn_r",
+        vmin=None,
+        vmax=None,
+        dpi=dpi,
+        figsize=figsize,
     )
     fig.colorbar(sc)
 
-    ax.imshow(he_image) if he_image is not None else None
+    ax.imshow(he_image, extent=he_extent) if he_image is not None else None
 
     if save_path is not None:
         fig.savefig(save_path, bbox_inches="tight")
 
-    he_image.close() if he_close else None
-
     return fig
 
 
@@ -534,14 +976,16 @@ def _spot_type_map(
         A matplotlib.figure.Figure plot.
     """
 
-    if draw_uncertain:
-        certain_spots = type_df.index
-    else:
-        certain_spots = type_df[type_df["spot_type"] != "uncertain"].index
-    coordinate_df = coordinate_df.reindex(index=certain_spots)
-    type_df = type_df.reindex(index=certain_spots)
+    # align coordinates to spot types once, then select spots by position
+    coordinate_df = coordinate_df.reindex(index=type_df.index)
+    x = coordinate_df["X"].to_numpy()
+    y = coordinate_df["Y"].to_numpy()
+    spot_types = type_df["type_1"].to_numpy()
+    if not draw_uncertain:
+        certain = type_df["spot_type"].to_numpy() != "uncertain"
+        x, y, spot_types = x[certain], y[certain], spot_types[certain]
 
-    ncs = len(set(type_df["type_1"]))
+    ncs = pd.Series(spot_types).nunique()
     if ncs <= 10:
         cmap = "tab10"
         ncol = 1
@@ -557,22 +1001,18 @@ def _spot_type_map(
     else:
         legend_fontsize = mpl.rcParams["legend.title_fontsize"]
 
-    he_close = False
-    figsize = (10, 10)
-    if he_image is not None:
-        if not isinstance(he_image, Image.Image):
-            he_close = True
-            he_image = Image.open(he_image)
-            figsize = (10, he_image.height / he_image.width * 10)
+    he_image, he_extent, figsize = _load_he_image(he_image, dpi)
 
-    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
+    fig = agg_figure(figsize=figsize, dpi=dpi)
+    ax = fig.subplots()
 
     sc = ax.scatter(
-        coordinate_df["X"],
-        coordinate_df["Y"],
+        x,
+        y,
         s=s,
-        c=type_df["type_1"],
+        c=spot_types,
         cmap=cmap,
+        rasterized=True,
     )
     leg = ax.legend(
         *sc.legend_elements(),
@@ -588,13 +1028,11 @@ def _spot_type_map(
     ax.set_yticks([])
     ax.set_title("Spot type map", fontsize=legend_fontsize)
 
-    ax.imshow(he_image) if he_image is not None else None
+    ax.imshow(he_image, extent=he_extent) if he_image is not None else None
 
     if save_path is not None:
         fig.savefig(save_path, bbox_inches="tight")
 
-    he_image.close() if he_close else None
-
     return fig
 
 
@@ -700,6 +1138,74 @@ def hotspot_distribution_map(
     )
 
 
+def hotspot_distribution_map_many(
+    dataset: STDataset,
+    clusters: list,
+    save_dir: Union[str, Path],
+    he_image: Optional[Union[str, Path, Image.Image]] = None,
+    s: float = 4,
+    dpi: float = 300,
+    file_format: str = "jpg",
+    cores: int = cpu_count(),
+) -> List[Path]:
+    """
+    Draw and save hotspot distribution maps for multiple SVG clusters.
+
+    Faster than calling ``hotspot_distribution_map`` for every cluster,
+    clusters are drawn in parallel processes and the figure and H&E image
+    are drawn only once in every process.
+
+    Parameters
+    ==========
+    dataset : STDataset
+        A STDataset with hotspot and SVG cluster estimation finished.
+
+    clusters : list
+        Which clusters to draw.
+
+    save_dir : str or pathlib.Path
+        Directory to save figures, named ``cluster_{cluster}.{file_format}``.
+
+    he_image : str, pathlib.Path or PIL.Image.Image, default None
+        H&E image of tissue. If None is given (default), distribution map
+        will not show tissue picture.
+
+    s : float, default 4
+        Spot size.
+
+    dpi : float, default 300
+        DPI for saved figure.
+
+    file_format : str, default "jpg"
+        File format of saved figures.
+
+    cores : int
+        Number of processes to draw figures. Use all available cpus by
+        default.
+
+    Returns
+    =======
+    save_paths : list
+        Paths of saved figures.
+    """
+    coor_df = dataset.coordinate_df
+    if he_image is None:
+        if dataset._array_coordinate is not None:
+            coor_df = dataset._array_coordinate
+    return _hotspot_distribution_map_many(
+        hotspot_df=dataset.hotspot_df,
+        coordinate_df=coor_df,
+        cluster_result=dataset.svg_cluster,
+        clusters=clusters,
+        save_dir=save_dir,
+        he_image=he_image,
+        s=s,
+        dpi=dpi,
+        file_format=file_format,
+        cores=cores,
+    )
+
+
 def hotspot_expression(
     dataset: STDataset,
     gene: str,
@@ -752,6 +1258,73 @@ def hotspot_expression(
     )
 
 
+def hotspot_expression_many(
+    dataset: STDataset,
+    genes: list,
+    save_dir: Union[str, Path],
+    he_image: Optional[Union[str, Path, Image.Image]] = None,
+    s: float = 4,
+    dpi: float = 300,
+    file_format: str = "jpg",
+    cores: int = cpu_count(),
+) -> List[Path]:
+    """
+    Draw and save hotspot expression for multiple genes.
+
+    Faster than calling ``hotspot_expression`` for every gene, genes are
+    drawn in parallel processes and the figure and H&E image are drawn only
+    once in every process.
+
+    Parameters
+    ==========
+    dataset : STDataset
+        A STDataset with hotspot estimation finished.
+
+    genes : list
+        Which genes to draw.
+
+    save_dir : str or pathlib.Path
+        Directory to save figures, named ``{gene}.{file_format}``.
+
+    he_image : str, pathlib.Path or PIL.Image.Image, default None
+        H&E image of tissue. If None is given (default), distribution map
+        will not show tissue picture.
+
+    s : float, default 4
+        Spot size.
+
+    dpi : float, default 300
+        DPI for saved figure.
+
+    file_format : str, default "jpg"
+        File format of saved figures.
+
+    cores : int
+        Number of processes to draw figures. Use all available cpus by
+        default.
+
+    Returns
+    =======
+    save_paths : list
+        Paths of saved figures.
+    """
+    coor_df = dataset.coordinate_df
+    if he_image is None:
+        if dataset._array_coordinate is not None:
+            coor_df = dataset._array_coordinate
+    return _hotspot_expression_many(
+        hotspot_df=dataset.hotspot_df,
+        coordinate_df=coor_df,
+        genes=genes,
+        save_dir=save_dir,
+        he_image=he_image,
+        s=s,
+        dpi=dpi,
+        file_format=file_format,
+        cores=cores,
+    )
+
+
 def hotspot_colocalization_map(
     dataset: STDataset,
     genes: list,
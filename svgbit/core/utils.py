@@ -1,42 +1,139 @@
 from __future__ import annotations
 
+from tempfile import TemporaryFile
+from typing import Optional, Tuple
+
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+import matplotlib as mpl
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import psutil
 from libpysal.weights import W as libpysal_W
+from scipy import sparse
 from scipy.stats import norm
 
 
-def pysal_to_pandas(W: libpysal_W) -> pd.DataFrame:
-    return pd.DataFrame(*W.full()).astype(int).T
+def zeros_matrix(shape: Tuple[int, int], dtype) -> np.ndarray:
+    """
+    Allocate a zero-filled Fortran-ordered matrix.
+
+    If the matrix takes more than a quarter of available memory, it is
+    backed by an anonymous temporary file with ``np.memmap`` so that the OS
+    can page out cold columns. The file is removed once the array is
+    garbage collected.
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if nbytes > psutil.virtual_memory().available / 4:
+        return np.memmap(
+            TemporaryFile(),
+            dtype=dtype,
+            mode="w+",
+            shape=shape,
+            order="F",
+        )
+    return np.zeros(shape, dtype=dtype, order="F")
+
+
+def df_to_spmatrix(df: pd.DataFrame, dtype=np.float64) -> sparse.csc_matrix:
+    """
+    Convert a (sparse or dense) DataFrame to a scipy CSC matrix, float64 by
+    default.
+
+    Sparse DataFrames are converted through their COO representation
+    without being densified.
+    """
+    try:
+        matrix = df.sparse.to_coo()
+    except AttributeError:
+        matrix = df.to_numpy(dtype=dtype)
+    return sparse.csc_matrix(matrix, dtype=dtype)
+
+
+def sparse_mean_std(X: sparse.spmatrix) -> Tuple[np.ndarray, np.ndarray]:
+    """Column means and population standard deviations of a sparse matrix."""
+    mean = np.asarray(X.mean(axis=0)).ravel()
+    var = np.asarray(X.multiply(X).mean(axis=0)).ravel() - mean**2
+    return mean, np.sqrt(np.clip(var, 0, None))
+
+
+def sparse_var(X: sparse.csc_matrix, ddof: int = 1) -> np.ndarray:
+    """
+    Column variances of a CSC matrix.
+
+    Deviations from the mean are summed (two-pass) as pandas and numpy do,
+    so constant columns get exactly 0 variance.
+    """
+    n_rows, n_cols = X.shape
+    mean = np.asarray(X.sum(axis=0)).ravel() / n_rows
+    nnz = np.diff(X.indptr)
+    deviation = X.data - np.repeat(mean, nnz)
+    squares = np.bincount(
+        np.repeat(np.arange(n_cols), nnz),
+        weights=deviation**2,
+        minlength=n_cols,
+    )
+    # implicit zeros deviate from the mean by -mean
+    squares += (n_rows - nnz) * mean**2
+    return squares / (n_rows - ddof)
+
+
+def pysal_to_neighbors(W: libpysal_W) -> np.ndarray:
+    """
+    Positional neighbor ids (n * max cardinality) of a libpysal W.
+
+    Rows follow ``W.id_order``, shorter neighbor lists are padded with -1.
+    """
+    positions = {j: i for i, j in enumerate(W.id_order)}
+    neighbors_arr = np.full((W.n, W.max_neighbors), -1, dtype=np.int32)
+    for i, j in enumerate(W.id_order):
+        neighbors = [positions[k] for k in W.neighbors[j]]
+        neighbors_arr[i, :len(neighbors)] = neighbors
+    return neighbors_arr
+
+
+def agg_figure(
+    figsize: Tuple[float, float],
+    dpi: Optional[float] = None,
+) -> Figure:
+    """
+    Create a figure drawn by the Agg canvas, outside of pyplot.
+
+    Figures are not registered in the global pyplot state, so they are
+    safe to draw in parallel and are freed once no longer referenced,
+    whatever the pyplot backend is.
+    """
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    return fig
 
 
 def plot_gmm(gmm, hist_data, save_path) -> None:
     """Plot a GMM given by sklearn."""
-    fig, ax = plt.subplots(figsize=(10, 10))
+    fig = agg_figure(figsize=(10, 10))
+    ax = fig.subplots()
     ax.hist(hist_data, bins=100, density=True, color="#f0a1a8")
     x = np.linspace(min(hist_data), max(hist_data), 5000)
-    ax.plot(
-        x,
-        np.exp(gmm.score_samples(x.reshape(-1, 1))),
-        lw=4,
-        label="GMM",
-    )
-    for i in range(gmm.get_params()["n_components"]):
+    # weighted densities of all components at once (5000 * n_components),
+    # summing to the GMM density of 1-D data
+    weights = gmm.weights_
+    pdfs = norm.pdf(
+        x[:, None],
+        gmm.means_[:, 0],
+        np.sqrt(gmm.covariances_.reshape(len(weights), -1)[:, 0]),
+    ) * weights
+    ax.plot(x, pdfs.sum(axis=1), lw=4, label="GMM")
+    for i in range(len(weights)):
         ax.plot(
             x,
-            norm.pdf(
-                x,
-                gmm.means_[i, 0],
-                gmm.covariances_[i, 0]**(1 / 2),
-            ) * gmm.weights_[i],
+            pdfs[:, i],
             lw=4,
             ls="--",
-            label=f"Gaussian {i}, weight {gmm.weights_[i]:.3f}",
+            label=f"Gaussian {i}, weight {weights[i]:.3f}",
         )
     ax.legend()
     fig.savefig(save_path)
 
 
 def get_cmap(length):
-    return plt.colormaps["hsv"].resampled(length)
+    return mpl.colormaps["hsv"].resampled(length)
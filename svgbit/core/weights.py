@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+from typing import Union
+
+import numpy as np
+import pandas as pd
+from libpysal.weights import W as libpysal_W
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+
+class KNNW(object):
+    """
+    KNNW: A lightweight KNN spatial weight built with scipy cKDTree.
+
+    Parameters
+    ==========
+    coordinates : pd.DataFrame or np.ndarray
+        Coordinates of spots (spot * dimension).
+
+    k : int, default 6
+        Number of nearest neighbors for KNN network.
+
+    Attributes
+    ==========
+    neighbors : np.ndarray
+        Positional neighbor ids (n * k) of each spot.
+
+    n : int
+        Number of spots.
+
+    k : int
+        Number of nearest neighbors.
+
+    transform : str
+        Weights transformation, one of 'O', 'B', 'R' and 'D' natively, other
+        libpysal transformations fall back to ``to_libpysal``.
+    """
+    def __init__(
+        self,
+        coordinates: Union[pd.DataFrame, np.ndarray],
+        k: int = 6,
+    ) -> None:
+        coordinates = np.asarray(coordinates, dtype=np.float64)
+        n = coordinates.shape[0]
+        workers = -1 if n > 10000 else 1
+        # same leafsize as libpysal, so that ties resolve identically
+        tree = cKDTree(coordinates, leafsize=10)
+        _, idx = tree.query(coordinates, k + 1, workers=workers)
+
+        # drop spot itself, or the farthest one if duplicated coordinates
+        # push itself out of the k + 1 nearest
+        is_self = idx == np.arange(n)[:, None]
+        is_self[~is_self.any(axis=1), -1] = True
+        self.neighbors = idx[~is_self].reshape(n, k).astype(np.int32)
+        self.n = n
+        self.k = k
+        self._transform = "O"
+
+    def __repr__(self) -> str:
+        return f"KNNW with n_spots = {self.n}, k = {self.k}"
+
+    @property
+    def transform(self) -> str:
+        """Weights transformation."""
+        return self._transform
+
+    @transform.setter
+    def transform(self, value: str):
+        self._transform = value.upper()
+
+    @property
+    def sparse(self) -> sparse.csr_matrix:
+        """Transformed spatial weight as a scipy CSR matrix."""
+        if self._transform in ("O", "B"):
+            value = 1.0
+        elif self._transform == "R":
+            value = 1.0 / self.k
+        elif self._transform == "D":
+            value = 1.0 / (self.n * self.k)
+        else:
+            return self.to_libpysal().sparse.tocsr()
+        W = sparse.csr_matrix(
+            (
+                np.full(self.n * self.k, value),
+                self.neighbors.ravel(),
+                np.arange(0, self.n * self.k + 1, self.k),
+            ),
+            shape=(self.n, self.n),
+        )
+        W.sort_indices()
+        return W
+
+    def to_libpysal(self) -> libpysal_W:
+        """
+        Convert to a libpysal.weights.W.
+
+        Returns
+        =======
+        W : libpysal.weights.W
+            An equivalent libpysal W with positional ids.
+
+        """
+        W = libpysal_W(
+            {i: row.tolist() for i, row in enumerate(self.neighbors)},
+            id_order=list(range(self.n)),
+            silence_warnings=True,
+        )
+        W.transform = self._transform
+        return W
+
+
+if __name__ == "__main__":
+    pass
@@ -1,5 +1,7 @@
 from .core.plot import svg_heatmap
 from .core.plot import hotspot_distribution_map
+from .core.plot import hotspot_distribution_map_many
 from .core.plot import spot_type_map
 from .core.plot import hotspot_expression, gene_expression
+from .core.plot import hotspot_expression_many
 from .core.plot import hotspot_colocalization_map
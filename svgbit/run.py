@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import cpu_count
 
 from .core.STDataset import STDataset
+from .core.utils import df_to_spmatrix
 
 
 def run(
@@ -38,8 +40,12 @@ def run(
         A STDataset with all evaluates done.
 
     """
-    dataset.acquire_weight(k=k)
-    dataset.acquire_hotspot(cores=cores)
+    # KNN tree query releases the GIL, overlap it with count matrix conversion
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        weight_future = executor.submit(dataset.acquire_weight, k=k)
+        count_mat = df_to_spmatrix(dataset.count_df)
+        weight_future.result()
+    dataset.acquire_hotspot(count_mat=count_mat, cores=cores)
     dataset.acquire_density(cores=cores)
     dataset.find_clusters(n_svgs=n_svgs, n_svg_clusters=n_svg_clusters)
 